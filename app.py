@@ -1,21 +1,28 @@
 import base64
 import os
 import time
-import uuid
-from os import mkdir
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
-from PIL import Image
 
-from image_generator import image_from_description
-from model import save_state, State, load_state, Storyline, Page
-from pdf_generator import generate_pdf
-from storyline_creator import generate_image_description, TEXT_FROM_STRUCTURE_PROMPT_TEMPLATE, \
-    generate_character_descriptions, generate_title, STRUCTURE_PROMPT_TEMPLATE, call
+# torch, diffusers and reportlab are not imported on startup: images are rendered by the image_queue worker and
+# pdf_generator is only imported in the last step, so a fresh app process renders step 0 right away
+from image_queue import submit, get_job, cancel, ensure_worker, prefetch, POLL_INTERVAL, PRIORITY_BULK, \
+    PRIORITY_INTERACTIVE, DRAFT_MODEL, DRAFT_RESOLUTION
+from llm_client import warm_up_in_background
+from model import State, Storyline, Page
+from run_store import new_run, save_state, load_state, update_page, list_runs
+from storyline_creator import generate_character_descriptions, generate_title, generate_story_outline, \
+    partial_outline, generate_pages, MAX_PARALLEL_CALLS, PAGE_COUNT
+from speculation import refill_topics, take_topics, speculate, claim, stats as speculation_stats
+from streaming import CoalescingStream
+from thumbnails import thumbnail
 from topic_creator import suggest_book_topics
+from tracing import trace_run, submit as submit_traced, load_trace, summarize, task_stats
 
 MODELS = ["gemma3n:e4b", "llama3.1:8b", "gemma3:12b", "phi4", "qwen3:14b"]
 IMAGE_MODELS = ["sdxl", "sd35"]
+GALLERY_PAGE_SIZE = 10
 
 st.set_page_config(page_title="Kinderbuch-Generator")
 st.title("📖 Kinderbuch Generator")
@@ -25,13 +32,26 @@ def choose_model():
     st.header("0. Modell")
     st.selectbox("Welches Modell möchtest du verwenden?", MODELS, key="model")
     st.selectbox("Welches Text-To-Image-Modell möchtest du verwenden?", IMAGE_MODELS, key="image_model")
+    st.number_input("Wie viele Seiten soll das Buch haben?", min_value=1, max_value=100, value=PAGE_COUNT,
+                    key="page_count")
+    st.checkbox("Schnellentwurf: Bilder schon während der Storyline generieren", key="fast_draft")
+    st.checkbox("Bildentwürfe: erst schnelle Entwürfe, volle Qualität nur für übernommene Bilder",
+                key="draft_images")
     if st.button("Modell bestätigen"):
         st.session_state.step = 1
-        st.session_state.run_id = str(uuid.uuid4())
+        st.session_state.run_id = new_run()
         print(f"Run ID: {st.session_state.run_id}")
-        mkdir(st.session_state.run_id)
-        state = State(model=st.session_state.model, image_model=st.session_state.image_model)
+        state = State(model=st.session_state.model, image_model=st.session_state.image_model,
+                      fast_draft=st.session_state.fast_draft, draft_images=st.session_state.draft_images,
+                      page_count=st.session_state.page_count)
         save_state(state, st.session_state.run_id)
+        # Text model and image pipeline load in the background while the user picks a topic
+        warm_up_in_background(state.model)
+        refill_topics(state.model)
+        ensure_worker()
+        if state.draft_images:
+            prefetch(DRAFT_MODEL)
+        prefetch(state.image_model)
         st.rerun()
 
 
@@ -39,10 +59,16 @@ def choose_topic():
     state = load_state(st.session_state.run_id)
     st.header("1. Thema")
     if "topics_generated" not in st.session_state:
-        with st.spinner("Schlage Themen vor..."):
-            state = suggest_book_topics(state)
-            st.session_state.topics_generated = True
-            save_state(state, st.session_state.run_id)
+        # Suggestions generated in the background since the model was confirmed are used right away
+        state.suggested_topics = take_topics(state.model)
+        if state.suggested_topics is None:
+            with st.spinner("Schlage Themen vor..."):
+                # Every book gets fresh suggestions, the LLM cache would return the same three for weeks
+                state = suggest_book_topics(state, use_cache=False)
+        st.session_state.topics_generated = True
+        save_state(state, st.session_state.run_id)
+        # The storylines of all suggestions are started while the user is still deciding
+        speculate(state.model, state.suggested_topics, state.page_count or PAGE_COUNT)
     selected_topic = st.radio("Welches Thema gefällt dir am besten?", state.suggested_topics)
     custom_topic = st.text_input("Oder gib ein eigenes Thema ein:")
 
@@ -53,19 +79,17 @@ def choose_topic():
         st.rerun()
 
 
-def stream_text_live(prompt: str, model: str):
-    placeholder = st.empty()
-    full_text = ""
+def outline_markdown(steps: list[str]) -> str:
+    return "\n".join(f"{i}. {step}" for i, step in enumerate(steps, start=1))
 
-    def update_ui(token):
-        nonlocal full_text
-        full_text += token
-        placeholder.markdown(full_text + "▌")  # blinking cursor feel
-        time.sleep(0.03)  # typing delay
 
-    final_response = call(model, prompt, token_callback=update_ui)
-    placeholder.markdown(final_response)  # remove cursor
-    return final_response
+def stream_outline_live(theme: str, model: str, page_count: int) -> list[str]:
+    placeholder = st.empty()
+    # Completed steps are shown in batches at a fixed frame rate, the generation itself is never slowed down
+    stream = CoalescingStream(lambda text: placeholder.markdown(outline_markdown(partial_outline(text)) + " ▌"))
+    outline = generate_story_outline(theme, model, page_count, token_callback=stream)
+    placeholder.markdown(outline_markdown(outline))  # remove cursor
+    return outline
 
 
 def choose_storyline():
@@ -73,29 +97,39 @@ def choose_storyline():
     st.header(f"2. {state.selected_topic or 'Storyline'}")
 
     if "storyline_generated" not in st.session_state:
+        run_id = st.session_state.run_id
+        draft_jobs = {}
+
+        # Fast draft: every page is queued for rendering as soon as its image description is written
+        def submit_draft(index: int, page: Page):
+            draft_jobs[index - 1] = submit_image(state, run_id, page, index - 1).id
+
+        if state.fast_draft:
+            ensure_worker()
+
         with st.spinner("Generiere Storyline..."):
-            # Show prompt being answered
-            st.subheader("Generierte Gliederung")
-            prompt = STRUCTURE_PROMPT_TEMPLATE.format(theme=state.selected_topic)
-            outline_text = stream_text_live(prompt, state.model)
-
-            # Parse and continue
-            title = generate_title(state.selected_topic, state.model)
-            character_descriptions = generate_character_descriptions(state.selected_topic, state.model)
-
-            pages = []
-            for i in range(1, 8):
-                st.subheader(f"Seite {i}")
-                page_prompt = TEXT_FROM_STRUCTURE_PROMPT_TEMPLATE.format(theme=state.selected_topic, title=title,
-                                                                         outline=outline_text, index=i)
-                page_text = stream_text_live(page_prompt, state.model)
-                prior_texts = "\n".join([f"{j + 1}. {p.text}" for j, p in enumerate(pages)])
-                image_description = generate_image_description(state.selected_topic, title, prior_texts, i, page_text,
-                                                               state.model, character_descriptions)
-                pages.append(Page(text=page_text, image_description=image_description))
+            page_count = state.page_count or PAGE_COUNT
+            # Calls already generated for this topic are replayed from the LLM cache
+            claim(state.model, state.selected_topic, state.suggested_topics, page_count)
+
+            # Title and characters are generated in the background while the outline is streamed
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CALLS) as executor:
+                title_future = submit_traced(executor, generate_title, state.selected_topic, state.model)
+                characters_future = submit_traced(executor, generate_character_descriptions, state.selected_topic,
+                                                  state.model)
+
+                # Show the outline while it is written
+                st.subheader("Generierte Gliederung")
+                outline = stream_outline_live(state.selected_topic, state.model, page_count)
+
+                title = title_future.result()
+                pages = generate_pages(state.selected_topic, title, outline, characters_future,
+                                       state.model, executor, page_count,
+                                       page_callback=submit_draft if state.fast_draft else None)
 
             state.storyline = Storyline(title=title, pages=pages)
             save_state(state, st.session_state.run_id)
+            st.session_state.image_jobs = draft_jobs
             st.session_state.storyline_generated = True
             st.rerun()
 
@@ -110,56 +144,134 @@ def choose_storyline():
                                               key=f"image_{i}")
 
     if st.button("Storyline bestätigen"):
+        # Draft images of edited image descriptions are discarded and rendered again in the next step
+        for j, job_id in list(st.session_state.image_jobs.items()):
+            if get_job(job_id).prompt != state.storyline.pages[j].image_description:
+                cancel(job_id)
+                del st.session_state.image_jobs[j]
         save_state(state, st.session_state.run_id)
         st.session_state.step = 3
         st.rerun()
 
 
+def image_path(run_id: str, j: int, draft: bool = False) -> str:
+    return os.path.join(run_id, f"page_{j:02d}_draft.png" if draft else f"page_{j:02d}.png")
+
+
+def submit_image(state: State, run_id: str, page: Page, j: int, priority: int = PRIORITY_BULK, final: bool = False):
+    # With image drafts, pages are drafted until the user approves them. Only then the configured model renders the
+    # final image from the draft, with the same prompt and seed.
+    if state.draft_images and not final:
+        job = submit(page.image_description, DRAFT_MODEL, image_path(run_id, j, draft=True), page.seed, priority,
+                     resolution=DRAFT_RESOLUTION)
+    else:
+        job = submit(page.image_description, state.image_model, image_path(run_id, j), page.seed, priority,
+                     init_image=page.draft_filepath)
+    page.seed = job.seed
+    return job
+
+
+def submit_page_image(state: State, j: int, priority: int = PRIORITY_BULK, final: bool = False):
+    job = submit_image(state, st.session_state.run_id, state.storyline.pages[j], j, priority, final)
+    st.session_state.image_jobs[j] = job.id
+
+
 def choose_pictures():
     st.header(f"3. {st.session_state.get('selected_topic', 'Storyline')}")
 
-    state = load_state(st.session_state.run_id)
-    total_pages = len(state.storyline.pages)
+    run_id = st.session_state.run_id
+    state = load_state(run_id)
+    ensure_worker()
 
-    if "current_page_index" not in st.session_state:
-        st.session_state.current_page_index = 0
+    if "images_submitted" not in st.session_state:
+        st.session_state.setdefault("image_jobs", {})
+        for j, page in enumerate(state.storyline.pages):
+            drafted = state.draft_images and page.draft_filepath is not None
+            if page.image_filepath is None and not drafted and j not in st.session_state.image_jobs:
+                submit_page_image(state, j)
+        st.session_state.images_submitted = True
+        save_state(state, st.session_state.run_id)
 
-    i = st.session_state.current_page_index
+    # The images are rendered by the worker process, this step only polls the job status
+    jobs = {j: get_job(job_id) for j, job_id in st.session_state.image_jobs.items()}
+    done = [j for j, job in jobs.items() if job.status == "done"]
+    for j in done:
+        job = jobs.pop(j)
+        field = "draft_filepath" if job.image_path == image_path(run_id, j, draft=True) else "image_filepath"
+        setattr(state.storyline.pages[j], field, job.image_path)
+        update_page(run_id, j, **{field: job.image_path})
+        del st.session_state.image_jobs[j]
+
+    pending = {j: job for j, job in jobs.items() if not job.finished}
+    if pending:
+        st.subheader(f"Generiere {len(pending)} von {len(state.storyline.pages)} Bildern...")
+        for j, job in pending.items():
+            st.progress(job.progress, text=f"Seite {j}: {'wartet' if job.status == 'queued' else 'wird generiert'}")
+        if st.button("Abbrechen"):
+            for job in pending.values():
+                cancel(job.id)
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
 
-    if i < total_pages:
-        with st.spinner(f"Generiere Bild {i + 1} von {total_pages}..."):
-            filepath = os.path.join(st.session_state.run_id, f"page_{i:02d}.png")
-            image_from_description(state.storyline.pages[i].image_description, state.image_model, filepath)
-            state.storyline.pages[i].image_filepath = filepath
-            save_state(state, st.session_state.run_id)
-            st.session_state.current_page_index += 1
+    # All final images were rendered after confirming the drafts
+    if st.session_state.pop("finalizing", False) and all(page.image_filepath for page in state.storyline.pages):
+        st.session_state.step = 4
+        st.rerun()
+
+    # Long books are reviewed a few pages at a time, the gallery only shows downscaled previews
+    pages = list(enumerate(state.storyline.pages))
+    if len(pages) > GALLERY_PAGE_SIZE:
+        starts = range(0, len(pages), GALLERY_PAGE_SIZE)
+        start = st.selectbox("Seiten", starts, key="gallery_start",
+                             format_func=lambda s: f"{s} – {min(s + GALLERY_PAGE_SIZE, len(pages)) - 1}")
+        pages = pages[start:start + GALLERY_PAGE_SIZE]
+
+    for j, page in pages:
+        st.subheader(f"Seite {j}")
+        st.markdown(f"**Text:** {page.text}")
+        if j in jobs:
+            st.error(f"Bild wurde nicht generiert: {jobs[j].error or 'abgebrochen'}")
+        if page.image_filepath or page.draft_filepath:
+            st.image(thumbnail(page.image_filepath or page.draft_filepath), use_container_width=True,
+                     caption=f"Seite {j}" if page.image_filepath else f"Seite {j} (Entwurf)")
+
+        if st.button(f"❌ Bild für Seite {j} neu generieren", key=f"regen_{j}"):
+            # Only this page is rendered again, with a new seed and ahead of bulk jobs of other users. A new draft
+            # replaces the final image made from the previous one.
+            page.seed = None
+            if state.draft_images:
+                page.image_filepath = None
+            submit_page_image(state, j, PRIORITY_INTERACTIVE)
+            update_page(run_id, j, seed=page.seed, image_filepath=page.image_filepath)
             st.rerun()
-    else:
-        # Show all generated images
-        for j, page in enumerate(state.storyline.pages):
-            st.subheader(f"Seite {j}")
-            st.markdown(f"**Text:** {page.text}")
-            image = Image.open(page.image_filepath)
-            st.image(image, caption=f"Seite {j}", use_container_width=True)
-
-            if st.button(f"❌ Bild für Seite {j} neu generieren", key=f"regen_{j}"):
-                os.remove(page.image_filepath)
-                del state.storyline.pages[j].image_filepath
-                st.session_state.current_page_index = j  # Start generation from this index
-                save_state(state, st.session_state.run_id)
+
+        if state.draft_images and page.draft_filepath and not page.image_filepath and j not in jobs:
+            if st.button(f"✅ Entwurf für Seite {j} übernehmen", key=f"approve_{j}"):
+                submit_page_image(state, j, final=True)
                 st.rerun()
 
-        if st.button("Alle Bilder bestätigen und weiter"):
+    if st.button("Alle Bilder bestätigen und weiter"):
+        if state.draft_images:
+            # Approves all remaining drafts, the next step follows once their final images exist
+            for j, page in enumerate(state.storyline.pages):
+                if page.image_filepath is None and page.draft_filepath and j not in st.session_state.image_jobs:
+                    submit_page_image(state, j, final=True)
+            st.session_state.finalizing = True
+        else:
             st.session_state.step = 4
-            st.rerun()
+        st.rerun()
 
 
 def show_bilderbuch():
+    from pdf_generator import generate_pdf
+
     st.header("4. Buch")
     state = load_state(st.session_state.run_id)
 
-    output_pdf_path = os.path.join(st.session_state.run_id, "kinderbuch.pdf")
-    pdf_path = generate_pdf(state, output_path=output_pdf_path)
+    quality = st.radio("Qualität", ["print", "web"], format_func={"print": "Druck", "web": "Web"}.get,
+                       horizontal=True)
+    output_pdf_path = os.path.join(st.session_state.run_id, f"kinderbuch_{quality}.pdf")
+    pdf_path = generate_pdf(state, output_path=output_pdf_path, quality=quality)
 
     st.success("📘 Das Buch wurde erfolgreich erstellt!")
 
@@ -167,18 +279,69 @@ def show_bilderbuch():
         st.download_button(label="📥 Buch herunterladen", data=f, file_name="kinderbuch.pdf", mime="application/pdf")
 
 
+def resume_step(state: State) -> int:
+    if state.selected_topic is None:
+        return 1
+    if state.storyline is None:
+        return 2
+    if any(page.image_filepath is None for page in state.storyline.pages):
+        return 3
+    return 4
+
+
+def show_runs():
+    runs = list_runs()
+    if not runs:
+        return
+    with st.sidebar.expander("📚 Frühere Bücher"):
+        labels = {run["run_id"]: f"{run['title'] or run['topic'] or 'Ohne Thema'} "
+                                 f"({time.strftime('%d.%m. %H:%M', time.localtime(run['updated']))})"
+                  for run in runs}
+        run_id = st.selectbox("Buch", list(labels), format_func=labels.get)
+        if st.button("Fortsetzen"):
+            # Progress flags of the current book would skip steps of the resumed one
+            for key in ["topics_generated", "storyline_generated", "images_submitted", "image_jobs", "finalizing",
+                        "gallery_start"]:
+                st.session_state.pop(key, None)
+            st.session_state.run_id = run_id
+            st.session_state.step = resume_step(load_state(run_id))
+            st.rerun()
+
+
+def show_timings():
+    with st.sidebar.expander("⏱️ Laufzeiten"):
+        records = load_trace(st.session_state.run_id)
+        stages = summarize(records)
+        if stages:
+            st.dataframe(stages, hide_index=True)
+            st.caption("LLM-Aufrufe je Aufgabe und Modell")
+            st.dataframe(task_stats(records), hide_index=True)
+        else:
+            st.caption("Noch keine Messungen.")
+        storylines = sum(speculation_stats[key] for key in ("storyline_hits", "storyline_partial", "storyline_misses"))
+        if storylines:
+            st.caption(f"Vorab generiert: {speculation_stats['storyline_hits']} von {storylines} Storylines "
+                       f"vollständig, {speculation_stats['storyline_partial']} teilweise; Themen "
+                       f"{speculation_stats['topic_hits']} von "
+                       f"{speculation_stats['topic_hits'] + speculation_stats['topic_misses']}")
+
 
 if __name__ == "__main__":
     if "step" not in st.session_state:
         st.session_state.step = 0
 
+    show_runs()
     if st.session_state.step == 0:
         choose_model()
-    elif st.session_state.step == 1:
-        choose_topic()
-    elif st.session_state.step == 2:
-        choose_storyline()
-    elif st.session_state.step == 3:
-        choose_pictures()
-    elif st.session_state.step == 4:
-        show_bilderbuch()
+    else:
+        # Timings of all stages are written to trace.jsonl next to state.json
+        with trace_run(st.session_state.run_id):
+            if st.session_state.step == 1:
+                choose_topic()
+            elif st.session_state.step == 2:
+                choose_storyline()
+            elif st.session_state.step == 3:
+                choose_pictures()
+            elif st.session_state.step == 4:
+                show_bilderbuch()
+        show_timings()
@@ -0,0 +1,180 @@
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+from fast_draft import generate_storyline_and_images
+from image_generator import generate_images_for_storyline, MODE_SETTINGS
+from llm_client import warm_up_in_background
+from model import State
+from pdf_generator import generate_pdf, PDF_QUALITY
+from run_store import load_state, save_state
+from storyline_creator import generate_storyline, ENGINES, PAGE_COUNT
+from topic_creator import suggest_book_topics
+from tracing import trace_run, load_trace, task_stats
+
+STAGES = ["storyline", "images", "pdf"]
+
+
+def plan_books(output_dir: str, model: str, image_model: str, topics: list[str] | None, count: int,
+               engine: str = "parallel", page_count: int = PAGE_COUNT) -> list[str]:
+    # Books that already have a state.json keep their topic, so an interrupted batch resumes where it stopped
+    os.makedirs(output_dir, exist_ok=True)
+    run_ids = [os.path.join(output_dir, f"book_{i:03d}") for i in range(len(topics) if topics else count)]
+    new_run_ids = [run_id for run_id in run_ids if not os.path.exists(os.path.join(run_id, "state.json"))]
+
+    if topics is None:
+        topics = []
+        while len(topics) < len(new_run_ids):
+            suggested = suggest_book_topics(State(model=model, image_model=image_model), use_cache=False)
+            new_topics = [topic for topic in dict.fromkeys(suggested.suggested_topics) if topic not in topics]
+            if not new_topics:
+                raise ValueError("Das Modell schlägt keine neuen Themen mehr vor.")
+            topics += new_topics
+    else:
+        topics = [topic for run_id, topic in zip(run_ids, topics) if run_id in new_run_ids]
+
+    for run_id, topic in zip(new_run_ids, topics):
+        os.makedirs(run_id, exist_ok=True)
+        save_state(State(model=model, image_model=image_model, selected_topic=topic, engine=engine,
+                         page_count=page_count), run_id)
+
+    return run_ids
+
+
+def images_missing(state: State) -> bool:
+    paths = [state.storyline.title_image_filepath] + [page.image_filepath for page in state.storyline.pages]
+    return any(path is None or not os.path.exists(path) for path in paths)
+
+
+class Stats:
+    def __init__(self):
+        self.durations = {stage: [] for stage in STAGES}
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.durations[stage].append(seconds)
+
+    def fail(self, run_id: str, stage: str, error: Exception):
+        print(f"{run_id}: {stage} fehlgeschlagen: {error}")
+        with self._lock:
+            self.failed.append(run_id)
+
+    def summary(self, books: int, seconds: float) -> str:
+        lines = [f"{books - len(self.failed)} von {books} Büchern in {seconds / 60:.1f} min "
+                 f"({(books - len(self.failed)) / seconds * 3600:.1f} Bücher/h)"]
+        for stage, durations in self.durations.items():
+            if durations:
+                lines.append(f"  {stage:<10} {len(durations):>4}x  gesamt {sum(durations):8.1f}s  "
+                             f"Schnitt {sum(durations) / len(durations):6.1f}s")
+        return "\n".join(lines)
+
+
+def task_summary(run_ids: list[str]) -> str:
+    # Per task and model, to tune BILDERBUCH_MODEL_ROUTES
+    lines = ["LLM-Aufrufe:"]
+    for group in task_stats([record for run_id in run_ids for record in load_trace(run_id)]):
+        line = f"  {group['task']:<17} {group['model']:<16} {group['count']:>5}x  {group['cached']:>5} Cache"
+        if group["errors"]:
+            line += f"  {group['errors']} Fehler"
+        if group["mean_seconds"] is not None:
+            line += f"  Schnitt {group['mean_seconds']:6.2f}s"
+        if group["tokens_per_second"] is not None:
+            line += f"  {group['mean_output_tokens']:6.0f} Tokens  {group['tokens_per_second']:6.1f} Tokens/s"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def run_stage(stats: Stats, run_id: str, stage: str, action) -> bool:
+    start = time.perf_counter()
+    try:
+        with trace_run(run_id):
+            action()
+    except Exception as e:
+        stats.fail(run_id, stage, e)
+        return False
+    stats.record(stage, time.perf_counter() - start)
+    return True
+
+
+def write_storyline(run_id: str, fast_draft: bool):
+    state = load_state(run_id)
+    if state.storyline is None:
+        state = generate_storyline_and_images(state, run_id) if fast_draft else generate_storyline(state)
+        save_state(state, run_id)
+
+
+def render_images(run_id: str):
+    state = load_state(run_id)
+    if images_missing(state):
+        # Rendered by the image worker, which the app shares, instead of a pipeline in this process
+        save_state(generate_images_for_storyline(state, run_id, queued=True), run_id)
+
+
+def run_batch(run_ids: list[str], llm_workers: int, quality: str, fast_draft: bool, stats: Stats) -> None:
+    # LLM, GPU and PDF stages run in their own threads, so the next storylines are written while images render
+    images_in, pdf_in = Queue(), Queue()
+
+    def llm_stage(run_id: str):
+        if run_stage(stats, run_id, "storyline", lambda: write_storyline(run_id, fast_draft)):
+            images_in.put(run_id)
+
+    def image_stage():
+        while (run_id := images_in.get()) is not None:
+            if run_stage(stats, run_id, "images", lambda: render_images(run_id)):
+                pdf_in.put(run_id)
+        pdf_in.put(None)
+
+    def pdf_stage():
+        while (run_id := pdf_in.get()) is not None:
+            output_path = os.path.join(run_id, f"kinderbuch_{quality}.pdf")
+            if run_stage(stats, run_id, "pdf", lambda: generate_pdf(load_state(run_id), output_path, quality)):
+                print(f"{run_id}: fertig")
+
+    threads = [threading.Thread(target=image_stage), threading.Thread(target=pdf_stage)]
+    for thread in threads:
+        thread.start()
+    with ThreadPoolExecutor(max_workers=llm_workers) as executor:
+        list(executor.map(llm_stage, run_ids))
+    images_in.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Erzeugt Bilderbücher ohne Streamlit.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--topics", help="Datei mit einem Thema pro Zeile")
+    source.add_argument("--count", type=int, help="Anzahl Bücher mit vorgeschlagenen Themen")
+    parser.add_argument("--model", default="gemma3:12b")
+    parser.add_argument("--image-model", default="sdxl", choices=list(MODE_SETTINGS))
+    parser.add_argument("--output-dir", default="batch")
+    parser.add_argument("--quality", default="print", choices=list(PDF_QUALITY))
+    parser.add_argument("--llm-workers", type=int, default=2, help="Bücher, deren Storyline gleichzeitig entsteht")
+    parser.add_argument("--fast-draft", action="store_true",
+                        help="Bilder schon rendern, während die Storyline noch geschrieben wird")
+    parser.add_argument("--pages", type=int, default=PAGE_COUNT, help="Seiten pro Buch")
+    parser.add_argument("--engine", default="parallel", choices=ENGINES,
+                        help="parallel: eine Anfrage pro Seite, conversation: ein Gespräch für das ganze Buch")
+    args = parser.parse_args()
+
+    topics = None
+    if args.topics:
+        with open(args.topics, "r", encoding="utf-8") as f:
+            topics = [line.strip() for line in f if line.strip()]
+
+    start = time.perf_counter()
+    warm_up_in_background(args.model)
+    run_ids = plan_books(args.output_dir, args.model, args.image_model, topics, args.count, args.engine, args.pages)
+    stats = Stats()
+    run_batch(run_ids, args.llm_workers, args.quality, args.fast_draft, stats)
+    print(stats.summary(len(run_ids), time.perf_counter() - start))
+    print(task_summary(run_ids))
+
+
+if __name__ == "__main__":
+    main()
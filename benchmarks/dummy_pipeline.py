@@ -0,0 +1,40 @@
+import random
+import time
+from types import SimpleNamespace
+
+import torch
+from PIL import Image
+
+
+class DummyPipeline:
+    # Stands in for the diffusers pipelines: same call signature, smooth noise images instead of diffusion
+    def __init__(self, seconds_per_step: float = 0.0):
+        self.seconds_per_step = seconds_per_step
+        self.device = torch.device("cpu")
+        self.components = {}
+        self._interrupt = False
+
+    @property
+    def interrupt(self) -> bool:
+        return self._interrupt
+
+    def to(self, device):
+        return self
+
+    def encode_prompt(self, prompt, prompt_2=None, do_classifier_free_guidance=False, **kwargs):
+        return torch.zeros(len(prompt), 77, 8), None, torch.zeros(len(prompt), 8), None
+
+    def __call__(self, prompt_embeds, num_inference_steps, height, width, generator, callback_on_step_end=None,
+                 **kwargs):
+        self._interrupt = False
+        for step in range(num_inference_steps):
+            time.sleep(self.seconds_per_step * len(generator))
+            if callback_on_step_end:
+                callback_on_step_end(self, step, None, {})
+
+        images = []
+        for g in generator:
+            noise = random.Random(g.initial_seed()).randbytes((width // 8) * (height // 8) * 3)
+            images.append(Image.frombytes("RGB", (width // 8, height // 8), noise).resize((width, height),
+                                                                                        Image.BICUBIC))
+        return SimpleNamespace(images=images)
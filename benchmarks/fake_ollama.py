@@ -0,0 +1,88 @@
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SENTENCE = "Die kleine Füchsin läuft durch den bunten Wald und entdeckt ein glitzerndes Geheimnis. "
+
+
+def fake_response(prompt: str) -> str:
+    # Just enough structure for the parsers in topic_creator and storyline_creator
+    if "JSON-Liste" in prompt:
+        return '["Der mutige Igel", "Ein Tag am Meer", "Die Sternenreise"]'
+    if "Gliederung für eine Geschichte" in prompt:
+        return "\n".join(f"{i}. {SENTENCE.strip()}" for i in range(1, 8))
+    return SENTENCE * 2
+
+
+def fake_structured(schema: dict, defs: dict | None = None):
+    # Fills a JSON schema with placeholder values, arrays get 7 items unless the schema fixes their length
+    defs = schema.get("$defs", defs)
+    if "$ref" in schema:
+        return fake_structured(defs[schema["$ref"].split("/")[-1]], defs)
+    if schema.get("type") == "object":
+        return {name: fake_structured(value, defs) for name, value in schema["properties"].items()}
+    if schema.get("type") == "array":
+        return [fake_structured(schema["items"], defs) for _ in range(schema.get("maxItems", 7))]
+    return SENTENCE.strip()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    tokens_per_second = 200.0
+    prompt_tokens_per_second = 2000.0
+    kv_cache: list[str] = []
+    kv_lock = threading.Lock()
+
+    def prefill(self, messages: list[dict], text: str) -> int:
+        # Like the server's KV cache, only prompt tokens after the longest prefix seen before are evaluated,
+        # estimated at 4 characters per token
+        prompt = "".join(message["role"] + message["content"] for message in messages)
+        with self.kv_lock:
+            cached = max((len(os.path.commonprefix([prompt, previous])) for previous in self.kv_cache), default=0)
+            self.kv_cache.append(prompt + "assistant" + text)
+            del self.kv_cache[:-64]
+        return (len(prompt) - cached) // 4
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        messages = body.get("messages") or []
+        if isinstance(body.get("format"), dict):
+            text = json.dumps(fake_structured(body["format"]), ensure_ascii=False)
+        else:
+            text = fake_response(messages[-1]["content"] if messages else "")
+        tokens = re.findall(r"\S+\s*", text)
+        prompt_tokens = self.prefill(messages, text)
+        time.sleep(prompt_tokens / self.prompt_tokens_per_second)
+        final = {"model": body["model"], "done": True, "done_reason": "stop", "prompt_eval_count": prompt_tokens,
+                 "prompt_eval_duration": int(prompt_tokens / self.prompt_tokens_per_second * 1e9),
+                 "eval_count": len(tokens), "eval_duration": int(len(tokens) / self.tokens_per_second * 1e9)}
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        if not body.get("stream", True):
+            time.sleep(len(tokens) / self.tokens_per_second)
+            self.wfile.write(json.dumps({**final, "message": {"role": "assistant", "content": text}}).encode())
+            return
+
+        for token in tokens:
+            time.sleep(1 / self.tokens_per_second)
+            chunk = {"model": body["model"], "done": False, "message": {"role": "assistant", "content": token}}
+            self.wfile.write((json.dumps(chunk) + "\n").encode())
+            self.wfile.flush()
+        self.wfile.write((json.dumps({**final, "message": {"role": "assistant", "content": ""}}) + "\n").encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_ollama(tokens_per_second: float, prompt_tokens_per_second: float = 2000.0) -> ThreadingHTTPServer:
+    handler = type("Handler", (FakeOllamaHandler,), {"tokens_per_second": tokens_per_second,
+                                                     "prompt_tokens_per_second": prompt_tokens_per_second,
+                                                     "kv_cache": [], "kv_lock": threading.Lock()})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
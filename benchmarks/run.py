@@ -0,0 +1,163 @@
+import argparse
+import ast
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.dummy_pipeline import DummyPipeline
+from benchmarks.fake_ollama import start_fake_ollama
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_REPEATS = 20
+
+# Must not be loaded before the user reaches the image and PDF steps
+HEAVY_MODULES = ["torch", "diffusers", "reportlab", "pypdf", "PIL"]
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+print(json.dumps({{"seconds": time.perf_counter() - start,
+                  "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+
+def timed(action) -> float:
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+def app_startup() -> float:
+    # Imports the project modules app.py loads on startup in a fresh interpreter, streamlit itself is left out
+    with open(os.path.join(REPO_DIR, "app.py"), "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = [node.module for node in tree.body if isinstance(node, ast.ImportFrom)] + \
+              [alias.name for node in tree.body if isinstance(node, ast.Import) for alias in node.names]
+    modules = [name for name in modules if os.path.exists(os.path.join(REPO_DIR, f"{name}.py"))]
+
+    output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT.format(modules=modules, heavy=HEAVY_MODULES)],
+                            cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output)
+    if result["heavy"]:
+        print(f"Warnung: app.py lädt beim Start {', '.join(result['heavy'])}")
+    print(f"{'app_startup':<24}             {result['seconds']:8.3f}s")
+    return result["seconds"]
+
+
+def run_benchmarks(page_counts: list[int], seconds_per_step: float) -> list[dict]:
+    # Imported after OLLAMA_HOST points to the fake server, the ollama client reads it on import
+    import image_cache
+    import image_generator
+    import llm_cache
+    from image_generator import generate_images_for_storyline, image_from_description
+    from model import State
+    from pdf_generator import generate_pdf
+    from pipeline_pool import PipelinePool
+    from run_store import save_state, load_state, update_page
+    from storyline_creator import generate_storyline
+
+    llm_cache.CACHE_ENABLED = False
+    image_cache.CACHE_ENABLED = False
+    image_generator.PIPELINES = PipelinePool(lambda name: DummyPipeline(seconds_per_step))
+
+    results = [{"name": "app_startup", "seconds": app_startup()}]
+    for pages in page_counts:
+        run_id = f"book_{pages}"
+        os.makedirs(run_id)
+        state = State(model="fake", image_model="sdxl", selected_topic="Der mutige Igel")
+
+        def record(name: str, seconds: float):
+            results.append({"name": f"{name}[{pages}]", "seconds": seconds})
+            print(f"{name:<24} {pages:>4} Seiten  {seconds:8.3f}s")
+
+        record("storyline", timed(lambda: generate_storyline(state, page_count=pages)))
+        conversation = State(model="fake", image_model="sdxl", selected_topic="Der mutige Igel", engine="conversation")
+        record("storyline_conversation", timed(lambda: generate_storyline(conversation, page_count=pages)))
+        record("images_batched", timed(lambda: generate_images_for_storyline(state, run_id)))
+        record("images_single", timed(lambda: [image_from_description(page.image_description, state.image_model,
+                                                                      os.path.join(run_id, "single.png"))
+                                               for page in state.storyline.pages]))
+        record("pdf", timed(lambda: generate_pdf(state, os.path.join(run_id, "book.pdf"))))
+        text = state.storyline.pages[0].text
+        state.storyline.pages[0].text = text + " Ende."
+        record("pdf_one_page_changed", timed(lambda: generate_pdf(state, os.path.join(run_id, "book.pdf"))))
+        record("save_state", timed(lambda: [save_state(state, run_id) for _ in range(STATE_REPEATS)]) / STATE_REPEATS)
+        record("load_state", timed(lambda: [load_state(run_id) for _ in range(STATE_REPEATS)]) / STATE_REPEATS)
+        record("update_page", timed(lambda: [update_page(run_id, i % pages, seed=i) for i in range(STATE_REPEATS)])
+               / STATE_REPEATS)
+        record("load_state_updated", timed(lambda: load_state(run_id)))
+
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    previous = {result["name"]: result["seconds"] for result in baseline}
+    regressions = []
+    print(f"\n{'Benchmark':<32} {'Baseline':>10} {'Jetzt':>10} {'Faktor':>8}")
+    for result in results:
+        if result["name"] not in previous:
+            continue
+        factor = result["seconds"] / previous[result["name"]] if previous[result["name"]] else 1.0
+        marker = ""
+        if factor > 1 + tolerance:
+            regressions.append(result["name"])
+            marker = "  REGRESSION"
+        print(f"{result['name']:<32} {previous[result['name']]:>9.3f}s {result['seconds']:>9.3f}s "
+              f"{factor:>7.2f}x{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Misst Text-, Bild- und PDF-Stufen mit lokalen Platzhaltern.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[7, 30, 100])
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Streaming-Rate des Fake-Ollama")
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=2000.0,
+                        help="Prefill-Rate des Fake-Ollama für Prompt-Tokens außerhalb des KV-Caches")
+    parser.add_argument("--seconds-per-step", type=float, default=0.0, help="Dauer eines Diffusionsschritts")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Erlaubte Verlangsamung gegenüber Baseline")
+    args = parser.parse_args()
+
+    server = start_fake_ollama(args.tokens_per_second, args.prompt_tokens_per_second)
+    os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # All caches and outputs are created in a scratch directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="bilderbuch_bench_")
+    os.chdir(workdir)
+    try:
+        results = run_benchmarks(args.pages, args.seconds_per_step)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+        server.shutdown()
+
+    report = {"pages": args.pages, "tokens_per_second": args.tokens_per_second,
+              "prompt_tokens_per_second": args.prompt_tokens_per_second,
+              "seconds_per_step": args.seconds_per_step, "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline gespeichert: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} Regression(en): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+
+import torch
+
+# Memory and speed features per device, MODE_SETTINGS[...]["devices"][device] overrides single entries.
+# torch.compile is off: batch sizes (coalesced jobs, halved after OOM) and resolutions (drafts, finals) change
+# between calls, and the first compilation takes longer than rendering a whole book with SDXL-Turbo.
+DEVICE_DEFAULTS = {
+    "cuda": {"dtype": "float16", "attention_slicing": False, "vae_slicing": True, "vae_tiling": False,
+             "cpu_offload": None, "channels_last": True, "compile": False},
+    "mps": {"dtype": "float16", "attention_slicing": True, "vae_slicing": True, "vae_tiling": False,
+            "cpu_offload": None, "channels_last": False, "compile": False},
+    "cpu": {"dtype": "bfloat16", "attention_slicing": False, "vae_slicing": True, "vae_tiling": False,
+            "cpu_offload": None, "channels_last": True, "compile": False},
+}
+
+
+def select_device() -> str:
+    # BILDERBUCH_DEVICE forces a device, e.g. "cpu" on a machine with a too small GPU
+    device = os.environ.get("BILDERBUCH_DEVICE")
+    if device:
+        return device
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def device_options(settings: dict, device: str) -> dict:
+    options = {**DEVICE_DEFAULTS[device], **settings.get("devices", {}).get(device, {})}
+    options["vae_tiling"] = options["vae_tiling"] or settings["use_vae_tiling"]
+    return options
+
+
+def optimize_pipeline(pipe, device: str, options: dict):
+    # Offloading moves the components to the device on demand, so the pipeline stays on the CPU
+    if options["cpu_offload"] == "sequential":
+        pipe.enable_sequential_cpu_offload(device=device)
+    elif options["cpu_offload"] == "model":
+        pipe.enable_model_cpu_offload(device=device)
+    else:
+        pipe.to(device)
+
+    if options["attention_slicing"]:
+        pipe.enable_attention_slicing()
+    if options["vae_slicing"]:
+        pipe.vae.enable_slicing()
+    if options["vae_tiling"]:
+        pipe.vae.enable_tiling()
+
+    unet = getattr(pipe, "unet", None)
+    if options["channels_last"]:
+        pipe.vae.to(memory_format=torch.channels_last)
+        if unet is not None:
+            unet.to(memory_format=torch.channels_last)
+
+    if options["compile"] and not options["cpu_offload"]:
+        # Dynamic shapes, so other batch sizes and resolutions don't trigger a recompilation each
+        if unet is not None:
+            pipe.unet = torch.compile(unet, dynamic=True)
+        else:
+            pipe.transformer = torch.compile(pipe.transformer, dynamic=True)
+
+    return pipe
+
+
+def reset_peak_memory() -> None:
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory() -> int | None:
+    # MPS only reports the memory currently held by the driver, not a peak
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated()
+    if torch.backends.mps.is_available():
+        return torch.mps.driver_allocated_memory()
+    return None
@@ -0,0 +1,34 @@
+import os
+
+from image_queue import submit, cancel, ensure_worker, wait_all, ImageJob
+from model import State, Page
+from storyline_creator import generate_storyline
+
+
+def generate_storyline_and_images(state: State, run_id: str) -> State:
+    # Every page is queued for the image worker as soon as its image description exists, while the LLM keeps
+    # writing the following pages. The worker coalesces whatever is queued into batches.
+    jobs: dict[int, tuple[Page, str, ImageJob]] = {}
+
+    def submit_page(index: int, page: Page):
+        filepath = os.path.join(run_id, "title.png" if index == 0 else f"page_{index - 1:02d}.png")
+        job = submit(page.image_description, state.image_model, os.path.abspath(filepath), page.seed)
+        page.seed = job.seed
+        jobs[index] = (page, filepath, job)
+
+    ensure_worker()
+    try:
+        state = generate_storyline(state, page_callback=submit_page)
+        cover = Page(text="", image_description=f"Make a cover for a children's book with this title: "
+                                                f"{state.storyline.title}", seed=state.storyline.title_image_seed)
+        submit_page(0, cover)
+        wait_all([job for _, _, job in jobs.values()])
+    except BaseException:
+        for _, _, job in jobs.values():
+            cancel(job.id)
+        raise
+
+    for page, filepath, _ in jobs.values():
+        page.image_filepath = filepath
+    state.storyline.title_image_filepath, state.storyline.title_image_seed = cover.image_filepath, cover.seed
+    return state
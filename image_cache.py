@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+CACHE_DIR = os.environ.get("BILDERBUCH_IMAGE_CACHE_DIR", os.path.join(".cache", "images"))
+# Set BILDERBUCH_IMAGE_CACHE=0 to always run the diffusion pipeline
+CACHE_ENABLED = os.environ.get("BILDERBUCH_IMAGE_CACHE", "1") != "0"
+MAX_CACHE_BYTES = int(os.environ.get("BILDERBUCH_IMAGE_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+_lock = threading.Lock()
+
+
+def image_key(model_id: str, steps: int, guidance: float, prompt: str, negative_prompt: str, seed: int,
+              width: int, height: int, init_image: str | None = None, strength: float | None = None) -> str:
+    payload = {"model": model_id, "steps": steps, "guidance": guidance, "prompt": prompt,
+               "negative_prompt": negative_prompt, "seed": seed, "width": width, "height": height}
+    # Refined images also depend on the content of the image they start from
+    if init_image is not None:
+        with open(init_image, "rb") as f:
+            payload["init_image"] = hashlib.sha256(f.read()).hexdigest()
+        payload["strength"] = strength
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.png")
+
+
+def load_image(key: str, image_path: str) -> bool:
+    if not CACHE_ENABLED:
+        return False
+
+    cache_path = _cache_path(key)
+    with _lock:
+        if not os.path.exists(cache_path):
+            return False
+        shutil.copyfile(cache_path, image_path)
+        # The modification time doubles as last access time for the LRU eviction
+        os.utime(cache_path)
+    return True
+
+
+def store_image(key: str, image_path: str) -> None:
+    if not CACHE_ENABLED:
+        return
+
+    cache_path = _cache_path(key)
+    with _lock:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        shutil.copyfile(image_path, cache_path)
+        _evict()
+
+
+def _evict() -> None:
+    entries = []
+    for directory, _, filenames in os.walk(CACHE_DIR):
+        for filename in filenames:
+            stat = os.stat(os.path.join(directory, filename))
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, filename)))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= MAX_CACHE_BYTES:
+            break
+        os.remove(path)
+        total -= size
@@ -1,10 +1,22 @@
+import math
 import os
+import random
+import time
+from typing import Callable
 
-import streamlit as st
 import torch
-from diffusers import StableDiffusionXLPipeline, StableDiffusion3Pipeline
-
-from model import load_state, State, save_state
+from diffusers import StableDiffusionXLPipeline, StableDiffusion3Pipeline, StableDiffusionXLImg2ImgPipeline, \
+    StableDiffusion3Img2ImgPipeline
+from PIL import Image
+
+from devices import select_device, device_options, optimize_pipeline, reset_peak_memory, peak_memory
+from image_cache import image_key, load_image, store_image
+from image_queue import render
+from model import State
+from pipeline_pool import PipelinePool, empty_device_cache
+from run_store import load_state, save_state
+from thumbnails import write_thumbnail
+from tracing import span, write as write_trace
 
 PROMPT_TEMPLATE = """
 Style: hand-drawn, warm, and poetic—blending detailed, nature-rich backgrounds with simple, expressive characters. 
@@ -15,62 +27,189 @@ Content: {content}
 
 NEGATIVE_PROMPT = "blurry, distorted, creepy, low quality, deformed, disfigured"
 
-MODE_SETTINGS = {"sdxl": {"model": "stabilityai/sdxl-turbo", "steps": 1, "guidance": 0.0, "use_vae_tiling": False, },
+MODE_SETTINGS = {"sdxl": {"model": "stabilityai/sdxl-turbo", "steps": 1, "guidance": 0.0, "use_vae_tiling": False,
+                          "batch_size": 4, "resolution": 1024, "refine_strength": 0.5, },
                  "sd35": {"model": "stabilityai/stable-diffusion-3.5-medium", "steps": 20, "guidance": 7.5,
-                          "use_vae_tiling": True, }}
+                          "use_vae_tiling": True, "batch_size": 2, "resolution": 1024, "refine_strength": 0.6,
+                          # The T5 text encoder alone takes ~9 GB, only the active component stays on the GPU
+                          "devices": {"cuda": {"cpu_offload": "model"}}, }}
+
+
+def load_pipeline(model_name: str):
+    settings = MODE_SETTINGS[model_name]
+    model_id = settings["model"]
+    device = select_device()
+    options = device_options(settings, device)
+    dtype = getattr(torch, options["dtype"])
+
+    with span("pipeline_load", model=model_name, device=device, dtype=options["dtype"]):
+        if "sdxl" in model_name:
+            pipe = StableDiffusionXLPipeline.from_pretrained(model_id, torch_dtype=dtype, variant="fp16")
+        elif "sd35" in model_name:
+            pipe = StableDiffusion3Pipeline.from_pretrained(model_id, torch_dtype=dtype)
+        else:
+            raise ValueError(f"Unknown model '{model_name}'.")
+
+        print(f"Lade {model_id} auf {device} ({options['dtype']})")
+        return optimize_pipeline(pipe, device, options)
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+# Shared by all Streamlit sessions and threads of the process
+PIPELINES = PipelinePool(load_pipeline)
 
 
 def get_pipeline(model_name: str):
-    if "pipeline_cache" not in st.session_state:
-        st.session_state.pipeline_cache = {}
+    return PIPELINES.acquire(model_name)
 
-    if model_name in st.session_state.pipeline_cache:
-        return st.session_state.pipeline_cache[model_name]
 
-    settings = MODE_SETTINGS[model_name]
-    model_id = settings["model"]
+def image_from_description(prompt: str, model: str, image_path: str, seed: int | None = None,
+                           queued: bool = False) -> int:
+    # queued renders in the image worker instead of this process
+    if queued:
+        return render([prompt], model, [image_path], [seed])[0]
+    return images_from_descriptions([prompt], model, [image_path], batch_size=1, seeds=[seed])[0]
 
-    if "sdxl" in model_name:
-        pipe = StableDiffusionXLPipeline.from_pretrained(model_id, torch_dtype=torch.float16, variant="fp16")
-        pipe.to("mps")
-        if settings["use_vae_tiling"]:
-            pipe.vae.enable_tiling()
-    elif "sd35" in model_name:
-        pipe = StableDiffusion3Pipeline.from_pretrained(model_id, torch_dtype=torch.float16)
-        pipe.to("mps")
-        if settings["use_vae_tiling"]:
-            pipe.vae.enable_tiling()
-    else:
-        raise ValueError(f"Unknown model '{model_name}'.")
 
-    st.session_state.pipeline_cache[model_name] = pipe
-    return pipe
+def refine_pipeline(pipe):
+    # img2img variant sharing all components of the loaded pipeline, so it costs no additional memory
+    if isinstance(pipe, StableDiffusion3Pipeline):
+        return StableDiffusion3Img2ImgPipeline.from_pipe(pipe, torch_dtype=pipe.dtype)
+    return StableDiffusionXLImg2ImgPipeline.from_pipe(pipe, torch_dtype=pipe.dtype)
 
 
-def image_from_description(prompt: str, model: str, image_path: str) -> None:
-    if model.lower() not in MODE_SETTINGS:
-        raise ValueError(f"Unknown mode '{model}'. Choose from: {', '.join(MODE_SETTINGS.keys())}")
+def is_out_of_memory(error: Exception) -> bool:
+    return isinstance(error, torch.OutOfMemoryError) or "out of memory" in str(error).lower()
 
-    pipe = get_pipeline(model.lower())
-    settings = MODE_SETTINGS[model.lower()]
 
-    image = pipe(prompt=PROMPT_TEMPLATE.format(content=prompt), negative_prompt=NEGATIVE_PROMPT,
-                 num_inference_steps=settings["steps"], guidance_scale=settings["guidance"]).images[0]
+def encode_prompts(pipe, prompts: list[str]):
+    # SD3 has a third (T5) text encoder and requires its prompt argument
+    extra = {"prompt_3": None} if isinstance(pipe, StableDiffusion3Pipeline) else {}
+    prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(prompt=prompts, prompt_2=None,
+                                                                   do_classifier_free_guidance=False, **extra)
+    return prompt_embeds, pooled_prompt_embeds
 
-    image.save(image_path)
 
+def images_from_descriptions(prompts: list[str], model: str, image_paths: list[str], batch_size: int | None = None,
+                             seeds: list[int | None] | None = None,
+                             step_callback: Callable[[int, int], bool] | None = None, resolution: int | None = None,
+                             init_images: list[str] | None = None) -> list[int]:
+    if model.lower() not in MODE_SETTINGS:
+        raise ValueError(f"Unknown mode '{model}'. Choose from: {', '.join(MODE_SETTINGS.keys())}")
 
-def generate_images_for_storyline(state: State, run_id: str) -> State:
-    filepath = os.path.join(run_id, f"title.png")
-    title = f"Make a cover for a children's book with this title: {state.storyline.title}"
-    image_from_description(title, state.image_model, filepath)
-    state.storyline.title_image_filepath = filepath
+    settings = dict(MODE_SETTINGS[model.lower()])
+    settings["resolution"] = resolution = resolution or settings["resolution"]
+    if init_images:
+        # Refining only runs the last part of the schedule, but at least one step
+        settings["steps"] = max(settings["steps"], math.ceil(1 / settings["refine_strength"]))
+    batch_size = batch_size or settings["batch_size"]
+    full_prompts = [PROMPT_TEMPLATE.format(content=p) for p in prompts]
+    seeds = [seed if seed is not None else random.randrange(2 ** 32) for seed in seeds or [None] * len(prompts)]
+    init_images = init_images or [None] * len(prompts)
+
+    # Images already rendered with the same settings, prompt and seed are copied from the cache
+    keys = [image_key(settings["model"], settings["steps"], settings["guidance"], prompt, NEGATIVE_PROMPT, seed,
+                      resolution, resolution, init_image, settings["refine_strength"])
+            for prompt, seed, init_image in zip(full_prompts, seeds, init_images)]
+    missing = [i for i, (key, image_path) in enumerate(zip(keys, image_paths)) if not load_image(key, image_path)]
+    if not missing:
+        return seeds
+
+    with get_pipeline(model.lower()) as pipe:
+        if init_images[0] is not None:
+            pipe = refine_pipeline(pipe)
+        render_images(pipe, settings, [full_prompts[i] for i in missing], [seeds[i] for i in missing],
+                      [image_paths[i] for i in missing], [keys[i] for i in missing], batch_size, step_callback,
+                      [init_images[i] for i in missing] if init_images[0] is not None else None)
+
+    return seeds
+
+
+def render_images(pipe, settings: dict, prompts: list[str], seeds: list[int], image_paths: list[str],
+                  keys: list[str], batch_size: int, step_callback: Callable[[int, int], bool] | None = None,
+                  init_images: list[str] | None = None) -> None:
+    use_negative = settings["guidance"] > 1.0
+    resolution = settings["resolution"]
+    total_steps = int(settings["steps"] * settings["refine_strength"]) if init_images else settings["steps"]
+
+    # The step callback reports progress and returns True to stop the remaining denoising steps
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        if step_callback and step_callback(step + 1, total_steps):
+            pipeline._interrupt = True
+        return callback_kwargs
+
+    # The shared negative prompt is only encoded once
+    if use_negative:
+        with torch.inference_mode():
+            negative_embeds, negative_pooled_embeds = encode_prompts(pipe, [NEGATIVE_PROMPT])
+
+    start = 0
+    while start < len(prompts):
+        end = min(start + batch_size, len(prompts))
+        kwargs = {"height": resolution, "width": resolution}
+        if init_images:
+            # The size of a refined image follows the size of its start image
+            kwargs = {"image": [Image.open(path).convert("RGB").resize((resolution, resolution), Image.LANCZOS)
+                                for path in init_images[start:end]], "strength": settings["refine_strength"]}
+        if use_negative:
+            kwargs.update({"negative_prompt_embeds": negative_embeds.expand(end - start, -1, -1),
+                           "negative_pooled_prompt_embeds": negative_pooled_embeds.expand(end - start, -1)})
+
+        batch_start = time.perf_counter()
+        reset_peak_memory()
+        try:
+            # Encoded per batch, so halving the batch after running out of memory also covers the text encoders
+            with torch.inference_mode():
+                prompt_embeds, pooled_embeds = encode_prompts(pipe, prompts[start:end])
+            images = pipe(prompt_embeds=prompt_embeds, pooled_prompt_embeds=pooled_embeds,
+                          num_inference_steps=settings["steps"], guidance_scale=settings["guidance"],
+                          generator=[torch.Generator("cpu").manual_seed(seed) for seed in seeds[start:end]],
+                          callback_on_step_end=on_step_end, **kwargs).images
+        except Exception as e:
+            if batch_size == 1 or not is_out_of_memory(e):
+                raise
+            batch_size = max(1, batch_size // 2)
+            empty_device_cache()
+            print(f"Zu wenig Speicher, verkleinere Batch auf {batch_size}")
+            continue
+        if pipe.interrupt:
+            raise GenerationCancelled()
+
+        seconds = time.perf_counter() - batch_start
+        per_image = seconds / len(images)
+        write_trace({"stage": "diffusion", "model": settings["model"], "batch_size": len(images),
+                     "steps": settings["steps"], "start": time.time() - seconds, "seconds": seconds,
+                     "steps_per_second": settings["steps"] / seconds, "peak_memory": peak_memory()})
+        for image, image_path, key in zip(images, image_paths[start:end], keys[start:end]):
+            image.save(image_path)
+            write_thumbnail(image, image_path)
+            store_image(key, image_path)
+            print(f"Bild {image_path} in {per_image:.1f}s generiert")
+        start = end
+
+
+def generate_images_for_storyline(state: State, run_id: str, batch_size: int | None = None,
+                                  queued: bool = False) -> State:
+    storyline = state.storyline
+    title = f"Make a cover for a children's book with this title: {storyline.title}"
+    prompts = [title] + [page.image_description for page in storyline.pages]
+    filepaths = [os.path.join(run_id, "title.png")] + [os.path.join(run_id, f"page_{i:02d}.png")
+                                                        for i in range(len(storyline.pages))]
+    seeds = [storyline.title_image_seed] + [page.seed for page in storyline.pages]
+
+    print(f"Generiere {len(prompts)} Bilder")
+    if queued:
+        # The worker coalesces the jobs into batches of its own size
+        seeds = render(prompts, state.image_model, filepaths, seeds)
+    else:
+        seeds = images_from_descriptions(prompts, state.image_model, filepaths, batch_size, seeds)
 
-    for i, page in enumerate(state.storyline.pages, start=0):
-        filepath = os.path.join(run_id, f"page_{i:02d}.png")
-        print(f"Generiere Bild {i + 1}")
-        image_from_description(page.image_description, state.image_model, filepath)
-        state.storyline.pages[i].image_filepath = filepath
+    storyline.title_image_filepath, storyline.title_image_seed = filepaths[0], seeds[0]
+    for page, filepath, seed in zip(storyline.pages, filepaths[1:], seeds[1:]):
+        page.image_filepath, page.seed = filepath, seed
 
     return state
 
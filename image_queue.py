@@ -0,0 +1,259 @@
+import fcntl
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from pydantic import BaseModel
+
+from tracing import trace_run
+
+QUEUE_PATH = os.environ.get("BILDERBUCH_IMAGE_QUEUE_PATH", "image_queue.sqlite")
+
+# Lower values are rendered first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Drafts are rendered with the 1-step SDXL-Turbo pipeline at its native resolution, the final image of an approved
+# page is refined from its draft with the configured model
+DRAFT_MODEL = "sdxl"
+DRAFT_RESOLUTION = 512
+
+POLL_INTERVAL = 0.5
+
+# The worker holds an exclusive lock on this file for its whole lifetime, including the imports of torch and
+# diffusers and pipeline loads that take minutes
+LOCK_PATH = f"{QUEUE_PATH}.lock"
+# A probe of ensure_worker briefly holds a shared lock, a worker that starts at that moment tries again
+LOCK_ATTEMPTS = 20
+
+# Worker started by this process, it may not have taken the lock yet
+_process: Optional[subprocess.Popen] = None
+_process_lock = threading.Lock()
+
+
+class ImageJob(BaseModel):
+    id: int
+    model: str
+    prompt: str
+    image_path: str
+    seed: int
+    priority: int
+    status: str  # queued, running, done, failed, cancelled
+    progress: float = 0.0
+    error: Optional[str] = None
+    resolution: Optional[int] = None
+    init_image: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    connection = sqlite3.connect(QUEUE_PATH, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    try:
+        connection.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT, "
+                           "prompt TEXT, image_path TEXT, seed INTEGER, priority INTEGER, status TEXT, "
+                           "progress REAL DEFAULT 0, error TEXT, created REAL, resolution INTEGER, init_image TEXT)")
+        # Queues created before draft rendering lack the last two columns
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+        for column in ("resolution INTEGER", "init_image TEXT"):
+            if column.split()[0] not in columns:
+                connection.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+        connection.execute("CREATE TABLE IF NOT EXISTS prefetch (model TEXT PRIMARY KEY, requested REAL)")
+        yield connection
+    finally:
+        connection.close()
+
+
+def _job(row: sqlite3.Row) -> ImageJob:
+    return ImageJob(**{key: row[key] for key in ImageJob.model_fields})
+
+
+def submit(prompt: str, model: str, image_path: str, seed: int | None = None, priority: int = PRIORITY_BULK,
+           resolution: int | None = None, init_image: str | None = None) -> ImageJob:
+    # The seed is fixed on submission so the caller can store it right away
+    seed = seed if seed is not None else random.randrange(2 ** 32)
+    with _connect() as connection:
+        cursor = connection.execute("INSERT INTO jobs (model, prompt, image_path, seed, priority, status, created, "
+                                    "resolution, init_image) VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+                                    (model.lower(), prompt, image_path, seed, priority, time.time(), resolution,
+                                     init_image))
+        return get_job(cursor.lastrowid)
+
+
+def get_job(job_id: int) -> ImageJob:
+    with _connect() as connection:
+        row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        raise ValueError(f"Unknown image job {job_id}.")
+    return _job(row)
+
+
+def cancel(job_id: int) -> None:
+    with _connect() as connection:
+        connection.execute("UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status IN ('queued', 'running')",
+                           (job_id,))
+
+
+def wait(job_id: int, timeout: float | None = None) -> ImageJob:
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while not (job := get_job(job_id)).finished:
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"Image job {job_id} did not finish in time.")
+        time.sleep(POLL_INTERVAL)
+    return job
+
+
+def wait_all(jobs: list[ImageJob]) -> None:
+    # Raises for the first image that failed or was cancelled
+    for job in jobs:
+        job = wait(job.id)
+        if job.status != "done":
+            raise RuntimeError(f"Bild {job.image_path} wurde nicht generiert: {job.error or 'abgebrochen'}")
+
+
+def render(prompts: list[str], model: str, image_paths: list[str], seeds: list[int | None] | None = None,
+           priority: int = PRIORITY_BULK) -> list[int]:
+    # Renders through the worker and waits, so processes next to the app (batch CLI) don't load pipelines onto the
+    # same device. The worker may run in another directory, so it gets absolute paths.
+    ensure_worker()
+    jobs = [submit(prompt, model, os.path.abspath(image_path), seed, priority)
+            for prompt, image_path, seed in zip(prompts, image_paths, seeds or [None] * len(prompts))]
+    try:
+        wait_all(jobs)
+    except BaseException:
+        for job in jobs:
+            cancel(job.id)
+        raise
+    return [job.seed for job in jobs]
+
+
+def prefetch(model: str) -> None:
+    # The worker loads the pipeline while it has nothing to render, e.g. while the user picks a topic
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO prefetch VALUES (?, ?)", (model.lower(), time.time()))
+
+
+def worker_running() -> bool:
+    with open(LOCK_PATH, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return False
+
+
+def ensure_worker() -> None:
+    global _process
+    with _process_lock:
+        if _process is not None and _process.poll() is None or worker_running():
+            return
+        _process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], start_new_session=True)
+
+
+def _claim_batch(connection: sqlite3.Connection, batch_sizes: dict[str, int]) -> list[ImageJob]:
+    # Takes the most urgent job and coalesces it with other queued jobs for the same model, resolution and kind
+    # (generated or refined), which can share a pipeline call
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        first = connection.execute("SELECT model, resolution, init_image FROM jobs WHERE status = 'queued' "
+                                   "ORDER BY priority, id LIMIT 1").fetchone()
+        if first is None:
+            return []
+        model = first["model"]
+        rows = connection.execute("SELECT * FROM jobs WHERE status = 'queued' AND model = ? AND resolution IS ? "
+                                  "AND (init_image IS NULL) = ? ORDER BY priority, id LIMIT ?",
+                                  (model, first["resolution"], first["init_image"] is None,
+                                   batch_sizes.get(model, 1))).fetchall()
+        connection.executemany("UPDATE jobs SET status = 'running' WHERE id = ?", [(row["id"],) for row in rows])
+        return [_job(row) for row in rows]
+    finally:
+        connection.execute("COMMIT")
+
+
+def _run_batch(connection: sqlite3.Connection, jobs: list[ImageJob]) -> None:
+    from image_generator import images_from_descriptions, GenerationCancelled
+
+    ids = [job.id for job in jobs]
+    placeholders = ", ".join("?" * len(ids))
+
+    def on_step(step: int, steps: int) -> bool:
+        connection.execute(f"UPDATE jobs SET progress = ? WHERE id IN ({placeholders}) AND status = 'running'",
+                           (step / steps, *ids))
+        running = connection.execute(f"SELECT COUNT(*) FROM jobs WHERE id IN ({placeholders}) "
+                                     f"AND status = 'running'", ids).fetchone()[0]
+        return running == 0
+
+    print(f"Generiere {len(jobs)} Bilder für {jobs[0].model}")
+    try:
+        # The trace of a batch is written to the run of its most urgent job
+        with trace_run(os.path.dirname(jobs[0].image_path) or "."):
+            init_images = [job.init_image for job in jobs] if jobs[0].init_image else None
+            images_from_descriptions([job.prompt for job in jobs], jobs[0].model, [job.image_path for job in jobs],
+                                     len(jobs), [job.seed for job in jobs], on_step, jobs[0].resolution, init_images)
+    except GenerationCancelled:
+        return
+    except Exception as e:
+        connection.execute(f"UPDATE jobs SET status = 'failed', error = ? WHERE id IN ({placeholders}) "
+                           f"AND status = 'running'", (str(e), *ids))
+        return
+    connection.execute(f"UPDATE jobs SET status = 'done', progress = 1 WHERE id IN ({placeholders}) "
+                       f"AND status = 'running'", ids)
+
+
+def _prefetch(connection: sqlite3.Connection) -> bool:
+    from image_generator import get_pipeline
+
+    row = connection.execute("SELECT model FROM prefetch ORDER BY requested LIMIT 1").fetchone()
+    if row is None:
+        return False
+    connection.execute("DELETE FROM prefetch WHERE model = ?", (row["model"],))
+    print(f"Lade Pipeline {row['model']} vorab")
+    try:
+        # Released right away, the pool keeps idle pipelines loaded within its budget
+        with get_pipeline(row["model"]):
+            pass
+    except Exception as e:
+        print(f"Konnte Pipeline {row['model']} nicht vorab laden: {e}")
+    return True
+
+
+def run_worker() -> None:
+    # Only one worker owns the device, further ones exit before importing torch
+    lock_file = open(LOCK_PATH, "a")
+    for attempt in range(LOCK_ATTEMPTS):
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if attempt == LOCK_ATTEMPTS - 1:
+                return
+            time.sleep(0.05)
+
+    from image_generator import MODE_SETTINGS
+
+    batch_sizes = {name: settings["batch_size"] for name, settings in MODE_SETTINGS.items()}
+    with _connect() as connection:
+        # Jobs of a previous worker that died while rendering are queued again
+        connection.execute("UPDATE jobs SET status = 'queued', progress = 0 WHERE status = 'running'")
+        print(f"Bild-Worker {os.getpid()} gestartet")
+        while True:
+            jobs = _claim_batch(connection, batch_sizes)
+            if jobs:
+                _run_batch(connection, jobs)
+            elif not _prefetch(connection):
+                time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+CACHE_PATH = os.environ.get("BILDERBUCH_LLM_CACHE_PATH", os.path.join(".cache", "llm.sqlite"))
+# Set BILDERBUCH_LLM_CACHE=0 to always ask the model again
+CACHE_ENABLED = os.environ.get("BILDERBUCH_LLM_CACHE", "1") != "0"
+MAX_CACHE_BYTES = int(os.environ.get("BILDERBUCH_LLM_CACHE_MAX_MB", "256")) * 1024 * 1024
+MAX_CACHE_AGE = float(os.environ.get("BILDERBUCH_LLM_CACHE_MAX_DAYS", "30")) * 24 * 60 * 60
+
+stats = {"hits": 0, "misses": 0}
+
+_lock = threading.Lock()
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    os.makedirs(os.path.dirname(CACHE_PATH) or ".", exist_ok=True)
+    with _lock:
+        connection = sqlite3.connect(CACHE_PATH, timeout=30)
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, "
+                               "response TEXT, size INTEGER, created REAL, accessed REAL)")
+            yield connection
+            connection.commit()
+        finally:
+            connection.close()
+
+
+def cache_key(model: str, messages: list[dict], options: Optional[dict] = None) -> str:
+    payload = json.dumps({"model": model, "messages": messages, "options": options or {}}, sort_keys=True,
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_response(key: str) -> Optional[str]:
+    if not CACHE_ENABLED:
+        return None
+
+    with _connect() as connection:
+        row = connection.execute("SELECT response FROM responses WHERE key = ? AND created > ?",
+                                 (key, time.time() - MAX_CACHE_AGE)).fetchone()
+        if row is None:
+            stats["misses"] += 1
+            return None
+        connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        stats["hits"] += 1
+        return row[0]
+
+
+def store_response(key: str, model: str, response: str) -> None:
+    if not CACHE_ENABLED:
+        return
+
+    now = time.time()
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, model, response, len(response.encode("utf-8")), now, now))
+        _evict(connection, now)
+
+
+def _evict(connection: sqlite3.Connection, now: float) -> None:
+    connection.execute("DELETE FROM responses WHERE created <= ?", (now - MAX_CACHE_AGE,))
+    # Least recently used entries beyond the size budget
+    connection.execute("DELETE FROM responses WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER "
+                       "(ORDER BY accessed DESC) AS total FROM responses) WHERE total > ?)", (MAX_CACHE_BYTES,))
+
+
+def clear() -> None:
+    with _connect() as connection:
+        connection.execute("DELETE FROM responses")
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from typing import Iterator, Optional
+
+import httpx
+from ollama import Client, ResponseError
+
+# Keeps the model loaded on the server while users take their time between steps
+KEEP_ALIVE = os.environ.get("BILDERBUCH_OLLAMA_KEEP_ALIVE", "30m")
+TIMEOUT = float(os.environ.get("BILDERBUCH_OLLAMA_TIMEOUT", "300"))
+RETRIES = 3
+BACKOFF_SECONDS = 1.0
+
+# Thinking models (qwen3) reason before every answer, which costs more tokens than the answer itself
+THINK = os.environ.get("BILDERBUCH_OLLAMA_THINK", "0") == "1"
+
+# Ollama reloads a model whenever num_ctx changes, so all tasks share one context size and only the output
+# length is limited per task. With thinking enabled the reasoning counts towards num_predict, so the limits
+# are not applied.
+DEFAULT_OPTIONS = {"num_ctx": int(os.environ.get("BILDERBUCH_OLLAMA_NUM_CTX", "8192"))}
+TASK_OPTIONS = {
+    "topics": {"num_predict": 256},
+    "title": {"num_predict": 64},
+    "outline": {"num_predict": 768},
+    "characters": {"num_predict": 512},
+    "page_text": {"num_predict": 256},
+    "image_description": {"num_predict": 160},
+    "book_page": {"num_predict": 256},
+}
+
+# Short tasks that need little creativity can run on a smaller, faster model than the one selected for the book.
+# The models of a task are tried in order, the selected model is always the last fallback. The conversation engine
+# is not routed, its turns share one KV cache.
+ROUTED_TASKS = ["topics", "title", "outline", "characters", "page_text", "image_description"]
+
+
+def parse_routes(spec: str) -> dict[str, list[str]]:
+    # "title=gemma3n:e4b;image_description=gemma3n:e4b,llama3.1:8b"
+    routes = {}
+    for entry in filter(None, (entry.strip() for entry in spec.split(";"))):
+        task, _, models = entry.partition("=")
+        if task.strip() not in ROUTED_TASKS:
+            raise ValueError(f"Unknown task '{task.strip()}' in BILDERBUCH_MODEL_ROUTES, choose from: "
+                             f"{', '.join(ROUTED_TASKS)}")
+        routes[task.strip()] = [model.strip() for model in models.split(",") if model.strip()]
+    return routes
+
+
+ROUTES = parse_routes(os.environ.get("BILDERBUCH_MODEL_ROUTES", ""))
+
+_client: Optional[Client] = None
+_lock = threading.Lock()
+
+
+def get_client() -> Client:
+    # One client per process, its HTTP connection pool is shared by all threads and sessions
+    global _client
+    with _lock:
+        if _client is None:
+            _client = Client(host=os.environ.get("OLLAMA_HOST"), timeout=TIMEOUT)
+        return _client
+
+
+def request_options(task: str | None = None, options: dict | None = None) -> dict:
+    task_options = {} if THINK else TASK_OPTIONS.get(task, {})
+    return {**DEFAULT_OPTIONS, **task_options, **(options or {})}
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, ResponseError):
+        return error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, ConnectionError))
+
+
+def model_unavailable(error: Exception) -> bool:
+    # Not pulled on the server, or still failing after all retries
+    return isinstance(error, ResponseError) and error.status_code == 404 or _retryable(error)
+
+
+def route(task: str | None, model: str) -> list[str]:
+    return list(dict.fromkeys([*ROUTES.get(task, []), model]))
+
+
+def routed_models(model: str) -> list[str]:
+    return list(dict.fromkeys([*(m for models in ROUTES.values() for m in models), model]))
+
+
+def _backoff(attempt: int) -> None:
+    time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+
+
+def chat(model: str, messages: list[dict], options: dict | None = None, **kwargs):
+    for attempt in range(RETRIES + 1):
+        try:
+            return get_client().chat(model=model, messages=messages, options=options, keep_alive=KEEP_ALIVE,
+                                     think=THINK, **kwargs)
+        except Exception as e:
+            if attempt == RETRIES or not _retryable(e):
+                raise
+            print(f"Ollama nicht erreichbar ({e}), neuer Versuch")
+            _backoff(attempt)
+
+
+def chat_stream(model: str, messages: list[dict], options: dict | None = None, **kwargs) -> Iterator:
+    # A stream is only retried before its first chunk, otherwise the caller would see tokens twice
+    for attempt in range(RETRIES + 1):
+        started = False
+        try:
+            for chunk in get_client().chat(model=model, messages=messages, options=options, keep_alive=KEEP_ALIVE,
+                                           think=THINK, stream=True, **kwargs):
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            if started or attempt == RETRIES or not _retryable(e):
+                raise
+            print(f"Ollama nicht erreichbar ({e}), neuer Versuch")
+            _backoff(attempt)
+
+
+def warm_up(model: str) -> None:
+    # A chat request without messages only loads the model, with the same num_ctx as the real requests
+    try:
+        chat(model, [], options=request_options())
+    except Exception as e:
+        print(f"Konnte {model} nicht vorladen: {e}")
+
+
+def warm_up_in_background(model: str) -> None:
+    # Loads the routed models of short tasks as well
+    for routed_model in routed_models(model):
+        threading.Thread(target=warm_up, args=(routed_model,), daemon=True).start()
@@ -1,7 +1,6 @@
-import json
 from typing import List, Optional
 
-from pydantic import ConfigDict, BaseModel
+from pydantic import ConfigDict, BaseModel, Field
 
 
 class Page(BaseModel):
@@ -9,12 +8,15 @@ class Page(BaseModel):
     text: str
     image_description: str
     image_filepath: Optional[str] = None
+    draft_filepath: Optional[str] = None
+    seed: Optional[int] = None
 
 
 class Storyline(BaseModel):
     model_config = ConfigDict(frozen=False)
     title: str
     title_image_filepath: Optional[str] = None
+    title_image_seed: Optional[int] = None
     pages: List[Page]
 
 
@@ -22,18 +24,54 @@ class State(BaseModel):
     model_config = ConfigDict(frozen=False)
     model: str
     image_model: str
+    fast_draft: bool = False
+    draft_images: bool = False
+    engine: str = "parallel"
+    page_count: Optional[int] = None
     suggested_topics: Optional[List[str]] = None
     selected_topic: Optional[str] = None
     storyline: Optional[Storyline] = None
 
 
-def save_state(state: State, run_id: str):
-    with open(f"{run_id}/state.json", "w", encoding="utf-8") as f:
-        f.write(state.model_dump_json(indent=2))
+# Response schemas for structured output, passed to Ollama as JSON schema
+class TopicSuggestions(BaseModel):
+    topics: List[str] = Field(min_length=3, max_length=3)
 
 
-def load_state(run_id: str) -> State:
-    with open(f"{run_id}/state.json", "r", encoding="utf-8") as f:
-        state_raw = json.load(f)
-        state = State(**state_raw)
-        return state
+class Title(BaseModel):
+    title: str
+
+
+class StoryOutline(BaseModel):
+    steps: List[str]
+
+
+class Character(BaseModel):
+    name: str
+    role: str
+    appearance: str
+    personality: str
+
+
+class Characters(BaseModel):
+    characters: List[Character] = Field(min_length=1, max_length=3)
+
+
+class PageText(BaseModel):
+    text: str
+
+
+class ImageDescription(BaseModel):
+    description: str
+
+
+class BookPlan(BaseModel):
+    title: str
+    characters: List[Character] = Field(min_length=1, max_length=3)
+    steps: List[str]
+
+
+class BookPage(BaseModel):
+    text: str
+    image_description: str
+
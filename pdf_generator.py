@@ -1,11 +1,26 @@
+import hashlib
 import os
 import textwrap
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 
+from PIL import Image
+from pypdf import PdfWriter
 from reportlab.lib.colors import black
 from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
 
-from model import State, load_state
+from model import State
+from run_store import load_state
+from tracing import span
+
+PAGE_SIZE = 8 * inch  # square page: 8x8 inches
+
+# Images are resampled to the target resolution of the 8x8" page and recompressed, dpi None keeps the original PNGs
+PDF_QUALITY = {"web": {"dpi": 96, "image_format": "JPEG", "quality": 80},
+               "print": {"dpi": 300, "image_format": "JPEG", "quality": 92},
+               "lossless": {"dpi": None, "image_format": "PNG", "quality": None}}
 
 
 def draw_wrapped_title(c, title, max_width, size):
@@ -70,33 +85,101 @@ def draw_text_box(c, text, size):
         y -= line_height
 
 
-def generate_pdf(state: State, output_path="bilderbuch.pdf"):
-    if state.storyline is None:
-        raise ValueError("No storyline available in state.")
+def prepare_image(path: str, max_pixels: int, image_format: str, quality: int) -> bytes:
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+        if max(image.size) > max_pixels:
+            image.thumbnail((max_pixels, max_pixels), Image.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format=image_format, quality=quality, optimize=True)
+    return buffer.getvalue()
 
-    size = 8 * inch  # square page: 8x8 inches
-    c = canvas.Canvas(output_path, pagesize=(size, size))
 
-    # Title Page
-    title = state.storyline.title
-    title_image_path = state.storyline.title_image_filepath
+def page_key(text: str | None, image_path: str | None, settings: dict) -> str:
+    digest = hashlib.sha256(repr(sorted(settings.items())).encode("utf-8"))
+    digest.update(repr(text).encode("utf-8"))
+    if image_path and os.path.exists(image_path):
+        with open(image_path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
 
-    if title_image_path and os.path.exists(title_image_path):
-        c.drawImage(title_image_path, 0, 0, width=size, height=size, preserveAspectRatio=True, anchor='c')
 
-    #draw_wrapped_title(c, title, max_width=size - 2 * inch, size=size)
-    c.showPage()
+def render_page(fragment_path: str, text: str | None, image_path: str | None, settings: dict) -> str:
+    size = PAGE_SIZE
+    c = canvas.Canvas(f"{fragment_path}.tmp", pagesize=(size, size))
 
-    # Content Pages
-    for page in state.storyline.pages:
-        if page.image_filepath and os.path.exists(page.image_filepath):
-            c.drawImage(page.image_filepath, 0, 0, width=size, height=size, preserveAspectRatio=True, anchor='c')
+    if image_path and os.path.exists(image_path):
+        image = image_path
+        if settings["dpi"] is not None:
+            image = ImageReader(BytesIO(prepare_image(image_path, round(size / inch * settings["dpi"]),
+                                                      settings["image_format"], settings["quality"])))
+        c.drawImage(image, 0, 0, width=size, height=size, preserveAspectRatio=True, anchor='c')
 
-        draw_text_box(c, page.text, size)
-        c.showPage()
+    if text is not None:
+        draw_text_box(c, text, size)
 
+    c.showPage()
     c.save()
-    print(f"Bilderbuch saved to {output_path}")
+    os.replace(f"{fragment_path}.tmp", fragment_path)
+    return fragment_path
+
+
+def pdf_key(state: State, settings: dict) -> str:
+    digest = hashlib.sha256(state.storyline.model_dump_json().encode("utf-8"))
+    digest.update(repr(sorted(settings.items())).encode("utf-8"))
+    for path in [state.storyline.title_image_filepath] + [page.image_filepath for page in state.storyline.pages]:
+        if path and os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def generate_pdf(state: State, output_path="bilderbuch.pdf", quality: str = "print", max_workers: int | None = None):
+    if state.storyline is None:
+        raise ValueError("No storyline available in state.")
+
+    settings = PDF_QUALITY[quality]
+    key = pdf_key(state, settings)
+    key_path = f"{output_path}.key"
+    if os.path.exists(output_path) and os.path.exists(key_path):
+        with open(key_path, "r", encoding="utf-8") as f:
+            if f.read() == key:
+                print(f"Bilderbuch unchanged at {output_path}")
+                return output_path
+
+    # Every page is rendered into its own single page PDF, only pages whose text or image changed are redrawn
+    fragments_dir = f"{output_path}.pages"
+    os.makedirs(fragments_dir, exist_ok=True)
+
+    # Title Page, without text box
+    contents = [(None, state.storyline.title_image_filepath)]
+    # Content Pages
+    contents += [(page.text, page.image_filepath) for page in state.storyline.pages]
+
+    fragments = [os.path.join(fragments_dir, f"{page_key(text, image_path, settings)}.pdf")
+                 for text, image_path in contents]
+    missing = [(fragment, text, image_path) for fragment, (text, image_path) in zip(fragments, contents)
+               if not os.path.exists(fragment)]
+
+    with span("pdf", quality=quality, pages=len(fragments), redrawn=len(missing)):
+        if len(missing) == 1:
+            render_page(*missing[0], settings)
+        elif missing:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(render_page, *zip(*missing), [settings] * len(missing)))
+
+        writer = PdfWriter()
+        for fragment in fragments:
+            writer.append(fragment)
+        writer.write(output_path)
+
+    for filename in os.listdir(fragments_dir):
+        if os.path.join(fragments_dir, filename) not in fragments:
+            os.remove(os.path.join(fragments_dir, filename))
+
+    with open(key_path, "w", encoding="utf-8") as f:
+        f.write(key)
+    print(f"Bilderbuch saved to {output_path}, {len(missing)} of {len(fragments)} pages redrawn")
     return output_path
 
 
@@ -0,0 +1,129 @@
+import gc
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+import torch
+
+# Pipelines not in use are moved to the CPU beyond the device budget and unloaded beyond the host budget
+DEVICE_BUDGET_BYTES = int(float(os.environ.get("BILDERBUCH_PIPELINE_DEVICE_BUDGET_GB", "12")) * 1024 ** 3)
+HOST_BUDGET_BYTES = int(float(os.environ.get("BILDERBUCH_PIPELINE_HOST_BUDGET_GB", "32")) * 1024 ** 3)
+
+
+def pipeline_size(pipe) -> int:
+    return sum(parameter.numel() * parameter.element_size() for component in pipe.components.values()
+               if isinstance(component, torch.nn.Module) for parameter in component.parameters())
+
+
+def empty_device_cache() -> None:
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    if torch.backends.mps.is_available():
+        torch.mps.empty_cache()
+
+
+class _Entry:
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.device = pipe.device
+        self.size = pipeline_size(pipe)
+        self.offloaded = False
+        self.refcount = 0
+        self.last_used = time.monotonic()
+        # Diffusers pipelines are not thread-safe, concurrent users of one pipeline take turns
+        self.lock = threading.Lock()
+
+    @property
+    def on_device(self) -> bool:
+        return self.device.type != "cpu" and not self.offloaded
+
+
+class PipelinePool:
+    def __init__(self, loader: Callable[[str], Any], device_budget: int = DEVICE_BUDGET_BYTES,
+                 host_budget: int = HOST_BUDGET_BYTES):
+        self._loader = loader
+        self._device_budget = device_budget
+        self._host_budget = host_budget
+        self._entries: dict[str, _Entry] = {}
+        # Device memory of pipelines that are being loaded or moved back to the device
+        self._reserved: dict[str, int] = {}
+        # Sizes of pipelines loaded before, to make room before loading them again
+        self._sizes: dict[str, int] = {}
+        self._name_locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, name: str) -> Iterator[Any]:
+        # Loading and moving a pipeline run outside the pool lock, so a load that takes minutes doesn't block other
+        # sessions. The lock per name makes concurrent users of the same pipeline wait for a single load.
+        with self._lock:
+            name_lock = self._name_locks.setdefault(name, threading.Lock())
+        with name_lock:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    entry.refcount += 1
+                if entry is None or entry.offloaded:
+                    # Idle pipelines leave the device before the new one arrives, not afterwards. An unknown
+                    # pipeline may need the whole budget.
+                    self._reserved[name] = entry.size if entry else self._sizes.get(name, self._device_budget)
+                    self._enforce_budget()
+
+            try:
+                if entry is None:
+                    print(f"Lade Pipeline {name}")
+                    entry = _Entry(self._loader(name))
+                    entry.refcount = 1
+                    with self._lock:
+                        self._entries[name] = entry
+                        self._sizes[name] = entry.size
+                elif entry.offloaded:
+                    entry.pipe.to(entry.device)
+                    with self._lock:
+                        entry.offloaded = False
+            except Exception:
+                with self._lock:
+                    if entry is not None:
+                        entry.refcount -= 1
+                raise
+            finally:
+                with self._lock:
+                    if self._reserved.pop(name, None) is not None:
+                        self._enforce_budget()
+
+        try:
+            with entry.lock:
+                yield entry.pipe
+        finally:
+            with self._lock:
+                entry.refcount -= 1
+                entry.last_used = time.monotonic()
+
+    def _enforce_budget(self) -> None:
+        idle = sorted(((name, entry) for name, entry in self._entries.items() if entry.refcount == 0),
+                      key=lambda item: item[1].last_used)
+        changed = False
+
+        for name, entry in idle:
+            on_device = sum(e.size for e in self._entries.values() if e.on_device) + sum(self._reserved.values())
+            if on_device <= self._device_budget:
+                break
+            if entry.on_device:
+                print(f"Verschiebe Pipeline {name} in den Arbeitsspeicher")
+                entry.pipe.to("cpu")
+                entry.offloaded = True
+                changed = True
+
+        for name, entry in idle:
+            if sum(e.size for e in self._entries.values() if not e.on_device) <= self._host_budget:
+                break
+            if not entry.on_device:
+                print(f"Entlade Pipeline {name}")
+                del self._entries[name]
+                changed = True
+
+        if changed:
+            empty_device_cache()
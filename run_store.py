@@ -0,0 +1,143 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+from model import State
+
+RUNS_DIR = os.environ.get("BILDERBUCH_RUNS_DIR", "runs")
+INDEX_PATH = os.environ.get("BILDERBUCH_RUN_INDEX_PATH", "runs.sqlite")
+STATE_FILENAME = "state.json"
+# Page updates are appended here and folded into state.json by the next full save
+PAGES_FILENAME = "pages.jsonl"
+
+# Merged state documents keyed by run, valid as long as mtime and size of both files are unchanged. Validating
+# the cached JSON is faster than deep copying a cached State, and callers are free to modify what they load.
+_cache: dict[str, tuple[tuple, str]] = {}
+_lock = threading.Lock()
+
+
+def new_run() -> str:
+    run_id = os.path.join(RUNS_DIR, str(uuid.uuid4()))
+    os.makedirs(run_id)
+    return run_id
+
+
+def _signature(run_id: str) -> tuple:
+    signature = []
+    for filename in (STATE_FILENAME, PAGES_FILENAME):
+        try:
+            stat = os.stat(os.path.join(run_id, filename))
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def save_state(state: State, run_id: str) -> None:
+    # Written next to the old file and renamed, so a crash leaves either the old or the new state behind
+    path = os.path.join(run_id, STATE_FILENAME)
+    data = state.model_dump_json()
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+        # On disk before the rename, otherwise a power loss can leave an empty state.json behind
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    directory = os.open(run_id, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+    # The snapshot contains all page updates. Should this be interrupted, replaying them again is harmless.
+    try:
+        os.remove(os.path.join(run_id, PAGES_FILENAME))
+    except FileNotFoundError:
+        pass
+
+    with _lock:
+        _cache[run_id] = (_signature(run_id), data)
+    _index(state, run_id)
+
+
+def update_page(run_id: str, index: int, **fields) -> None:
+    # Appends a single line instead of rewriting the whole book for every finished image
+    line = json.dumps({"index": index, **fields}, ensure_ascii=False) + "\n"
+    with open(os.path.join(run_id, PAGES_FILENAME), "a+b") as f:
+        # A line torn by a crash gets skipped on reading, the update after it must not be appended to it
+        end = f.seek(0, os.SEEK_END)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b"\n":
+                line = "\n" + line
+        f.write(line.encode("utf-8"))
+
+
+def _read(run_id: str) -> str:
+    with open(os.path.join(run_id, STATE_FILENAME), "r", encoding="utf-8") as f:
+        data = f.read()
+    try:
+        with open(os.path.join(run_id, PAGES_FILENAME), "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return data
+
+    state = json.loads(data)
+    for line in lines:
+        try:
+            update = json.loads(line)
+        except ValueError:
+            # Last line of an interrupted append
+            continue
+        state["storyline"]["pages"][update.pop("index")].update(update)
+    return json.dumps(state, ensure_ascii=False)
+
+
+def load_state(run_id: str) -> State:
+    signature = _signature(run_id)
+    with _lock:
+        cached = _cache.get(run_id)
+    if cached is not None and cached[0] == signature:
+        data = cached[1]
+    else:
+        data = _read(run_id)
+        with _lock:
+            _cache[run_id] = (signature, data)
+    return State.model_validate_json(data)
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    connection = sqlite3.connect(INDEX_PATH, timeout=30)
+    try:
+        connection.execute("CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, topic TEXT, title TEXT, "
+                           "model TEXT, image_model TEXT, pages INTEGER, created REAL, updated REAL)")
+        yield connection
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _index(state: State, run_id: str) -> None:
+    storyline = state.storyline
+    now = time.time()
+    with _connect() as connection:
+        connection.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (run_id) DO UPDATE SET "
+                           "topic = excluded.topic, title = excluded.title, pages = excluded.pages, "
+                           "updated = excluded.updated",
+                           (os.path.abspath(run_id), state.selected_topic, storyline and storyline.title, state.model,
+                            state.image_model, storyline and len(storyline.pages), now, now))
+
+
+def list_runs(limit: int = 50) -> list[dict]:
+    # Most recently changed first, runs whose directory was deleted in the meantime are skipped
+    with _connect() as connection:
+        connection.row_factory = sqlite3.Row
+        rows = connection.execute("SELECT * FROM runs ORDER BY updated DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(row) for row in rows if os.path.exists(os.path.join(row["run_id"], STATE_FILENAME))]
@@ -0,0 +1,141 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import llm_cache
+from storyline_creator import generate_title, generate_character_descriptions, generate_story_outline
+from topic_creator import suggest_topics
+from tracing import span
+
+# While the user decides, suggestions and the first storyline calls of every suggested topic are generated in the
+# background. The results land in the LLM cache, where choose_storyline finds them. BILDERBUCH_SPECULATION=0
+# turns this off.
+ENABLED = os.environ.get("BILDERBUCH_SPECULATION", "1") != "0"
+# Background calls compete with the user's own requests for the parallel slots of Ollama
+WORKERS = int(os.environ.get("BILDERBUCH_SPECULATION_WORKERS", "2"))
+# Topics whose storyline is generated ahead at the same time, over all sessions
+MAX_BRANCHES = int(os.environ.get("BILDERBUCH_SPECULATION_BRANCHES", "6"))
+# Fresh topic suggestions kept ready per model
+POOL_SIZE = 2
+
+stats = {"topic_hits": 0, "topic_misses": 0, "storyline_hits": 0, "storyline_partial": 0, "storyline_misses": 0,
+         "cancelled_calls": 0}
+OUTCOME_STATS = {"hit": "storyline_hits", "partial": "storyline_partial", "miss": "storyline_misses"}
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="speculation")
+_lock = threading.Lock()
+_pools: dict[str, list[list[str]]] = {}
+_refills: dict[str, Future] = {}
+_branches: dict[tuple[str, str, int], "Branch"] = {}
+
+
+class SpeculationCancelled(Exception):
+    pass
+
+
+class Branch:
+    # The storyline calls speculated for one topic
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.futures: list[Future] = []
+
+    def check(self, _token: str = "") -> None:
+        # Token callback of the streamed outline, closes the request of a losing branch
+        if self.cancelled.is_set():
+            raise SpeculationCancelled()
+
+    @property
+    def active(self) -> bool:
+        return not all(future.done() for future in self.futures)
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        for future in self.futures:
+            if future.cancel() or future.running():
+                stats["cancelled_calls"] += 1
+
+
+def _fill(model: str) -> None:
+    try:
+        # Bypasses the LLM cache, which would return the same suggestions every time
+        while len(_pools.get(model, [])) < POOL_SIZE:
+            topics = suggest_topics(model, use_cache=False)
+            with _lock:
+                _pools.setdefault(model, []).append(topics)
+    except Exception as e:
+        print(f"Konnte Themen für {model} nicht vorab generieren: {e}")
+
+
+def refill_topics(model: str) -> None:
+    if not ENABLED:
+        return
+    with _lock:
+        if len(_pools.get(model, [])) >= POOL_SIZE or (model in _refills and not _refills[model].done()):
+            return
+        _refills[model] = _executor.submit(_fill, model)
+
+
+def take_topics(model: str) -> list[str] | None:
+    with _lock:
+        pool = _pools.get(model)
+        topics = pool.pop(0) if pool else None
+    stats["topic_hits" if topics else "topic_misses"] += 1
+    refill_topics(model)
+    return topics
+
+
+def _run(branch: Branch, fn, *args, **kwargs):
+    try:
+        branch.check()
+        return fn(*args, **kwargs)
+    except SpeculationCancelled:
+        return None
+
+
+def speculate(model: str, topics: list[str], page_count: int) -> None:
+    # Speculation only pays off if the LLM cache keeps the results
+    if not ENABLED or not llm_cache.CACHE_ENABLED:
+        return
+    with _lock:
+        # Finished branches of topics nobody picked only keep their results in the LLM cache
+        for key in [key for key, branch in _branches.items() if not branch.active][:-MAX_BRANCHES or None]:
+            del _branches[key]
+        active = sum(branch.active for branch in _branches.values())
+        new = []
+        for topic in topics:
+            key = (model, topic, page_count)
+            if key not in _branches and active + len(new) < MAX_BRANCHES:
+                _branches[key] = Branch()
+                new.append((topic, _branches[key]))
+        # The streamed outline is the longest wait, it is started for every topic before the shorter calls
+        for topic, branch in new:
+            branch.futures.append(_executor.submit(_run, branch, generate_story_outline, topic, model, page_count,
+                                                   token_callback=branch.check))
+        for fn in (generate_title, generate_character_descriptions):
+            for topic, branch in new:
+                branch.futures.append(_executor.submit(_run, branch, fn, topic, model))
+
+
+def claim(model: str, topic: str, topics: list[str], page_count: int) -> str:
+    # Cancels the branches of the other suggestions and waits for the running calls of the chosen topic, its
+    # queued calls are left to the caller. Returns hit, partial or miss.
+    with _lock:
+        for other in topics or []:
+            if other != topic and (branch := _branches.pop((model, other, page_count), None)):
+                branch.cancel()
+        branch = _branches.pop((model, topic, page_count), None)
+    if branch is None:
+        stats[OUTCOME_STATS["miss"]] += 1
+        return "miss"
+
+    with span("speculation", topic=topic) as record:
+        started = [future for future in branch.futures if not future.cancel()]
+        for future in started:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Vorab generierter Aufruf fehlgeschlagen: {e}")
+        outcome = record["outcome"] = "hit" if len(started) == len(branch.futures) else \
+            "partial" if started else "miss"
+    stats[OUTCOME_STATS[outcome]] += 1
+    return outcome
@@ -1,6 +1,37 @@
-from ollama import chat
+import json
+import os
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, List
 
-from model import State, Page, Storyline, load_state
+from pydantic import BaseModel, ValidationError, Field, create_model
+
+from llm_cache import cache_key, load_response, store_response
+from llm_client import chat_stream, request_options, route, model_unavailable, TASK_OPTIONS
+from model import State, Page, Storyline, Title, StoryOutline, Characters, PageText, ImageDescription, \
+    BookPlan, BookPage
+from run_store import load_state
+from tracing import span, add_eval_stats, submit
+
+PAGE_COUNT = 7
+ENGINES = ["parallel", "conversation"]
+
+# Sections of the story with their share of the pages, the weights reproduce the original 7 page layout
+STORY_SECTIONS = [("Einführung", 1), ("Problem/Konflikt", 1), ("steigende Handlung", 2), ("Höhepunkt", 1),
+                  ("Auflösung", 1), ("Schluss", 1)]
+
+# Pages before this window are left out of the prompts, so the prompt size per page stays constant in long books.
+# Books up to PAGE_COUNT pages always see all prior pages.
+CONTEXT_WINDOW_PAGES = int(os.environ.get("BILDERBUCH_CONTEXT_WINDOW_PAGES", str(PAGE_COUNT - 1)))
+
+# Responses follow a JSON schema instead of being parsed from free text (BILDERBUCH_STRUCTURED_OUTPUT=0 to disable)
+STRUCTURED_OUTPUT = os.environ.get("BILDERBUCH_STRUCTURED_OUTPUT", "1") != "0"
+STRUCTURED_SUFFIX = "\nAntworte ausschließlich mit JSON nach diesem Schema:\n{schema}"
+JSON_STRING_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+# Should match OLLAMA_NUM_PARALLEL of the server, more concurrent requests are queued there anyway.
+MAX_PARALLEL_CALLS = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
 
 TITLE_PROMPT_TEMPLATE = '''
 Du bist ein kreativer Kinderbuchautor. 
@@ -9,16 +40,11 @@ Der Titel soll neugierig machen, kindgerecht sein und zur Altersgruppe 4–8 pas
 '''
 
 STRUCTURE_PROMPT_TEMPLATE = '''
-Du bist ein Kinderbuchautor und schreibst ein kurzes illustriertes Buch für Kinder im Alter von 4–8 Jahren. 
+Du bist ein Kinderbuchautor und schreibst ein illustriertes Buch mit {page_count} Seiten für Kinder im Alter von 4–8 Jahren. 
 Das Thema lautet: "{theme}"
-Erstelle eine kurze Gliederung für eine Geschichte zu diesem Thema.
+Erstelle eine Gliederung für eine Geschichte zu diesem Thema mit genau {page_count} Schritten, einem pro Seite.
 Folge dabei dieser Struktur:
-1 Seite Einführung, 
-1 Seiten Problem/Konflikt, 
-2 Seiten steigende Handlung, 
-1 Seite Höhepunkt, 
-1 Seite Auflösung, 
-1 Seite Schluss.
+{structure}
 
 Die Geschichte soll kindgerecht, einfach und gut illustrierbar sein. 
 Jeder Schritt soll aus 1–2 kurzen Sätzen bestehen. 
@@ -76,6 +102,25 @@ Return as a list.
 Mind that this will be included in all image descriptions, so keep it very short and efficient.
 '''
 
+BOOK_SYSTEM_PROMPT_TEMPLATE = '''
+Du bist Kinderbuchautor und Illustrator und schreibst ein illustriertes Buch mit {page_count} Seiten für Kinder im Alter von 4–8 Jahren.
+Das Thema lautet: "{theme}"
+Die Geschichte soll kindgerecht, einfach und gut illustrierbar sein.
+Du legst zuerst das Buch an und schreibst danach Seite für Seite, jeweils mit:
+- text: 1–3 kurze Sätze in einfacher Sprache, die im Buch abgedruckt werden, ohne Überschrift, Seitennummer oder Kommentare.
+- image_description: a super short English text-to-image prompt for the illustration of the page (77 tokens at most), consistent with the characters and previous illustrations, with bright colors and a clear scene.
+'''
+
+BOOK_PLAN_PROMPT_TEMPLATE = '''
+Lege das Buch an:
+- title: ein Titel, der neugierig macht.
+- characters: 1–3 wiederkehrende Figuren mit Name, Rolle, Aussehen (Alter, Kleidung, Farben, Besonderheiten) und Persönlichkeit, sehr kurz und auf Englisch.
+- steps: eine Gliederung mit genau {page_count} Schritten aus je 1–2 kurzen Sätzen, von der Einführung über Konflikt, steigende Handlung, Höhepunkt und Auflösung bis zum Schluss.
+Schreibe noch nicht den Text der Geschichte.
+'''
+
+BOOK_PAGE_PROMPT_TEMPLATE = "Schreibe Seite {index}."
+
 
 def clean_page_text(text: str) -> str:
     lines = text.strip().split('\n')
@@ -93,42 +138,214 @@ def clean_page_text(text: str) -> str:
 
 def generate_character_descriptions(theme: str, model: str) -> list[str]:
     prompt = CHARACTER_DESCRIPTION_PROMPT_TEMPLATE.format(theme=theme)
-    result = call(model, prompt)
+    if STRUCTURED_OUTPUT:
+        characters = call_structured(model, prompt, Characters, task="characters").characters
+        return [f"{c.name} ({c.role}): {c.appearance}. {c.personality}" for c in characters]
+    result = call(model, prompt, task="characters")
     return [line.strip() for line in result.strip().split('\n') if line.strip()]
 
 
-def call(model: str, prompt: str, token_callback=None) -> str:
-    stream = chat(model=model, messages=[{"role": "user", "content": prompt}], stream=True)
-    response = ""
+def is_complete_json(text: str) -> bool:
+    try:
+        json.loads(text)
+        return True
+    except ValueError:
+        return False
+
+
+def matches_schema(text: str, schema: type[BaseModel]) -> bool:
+    try:
+        schema.model_validate_json(text)
+        return True
+    except ValidationError:
+        return False
 
-    for chunk in stream:
-        content = chunk['message']['content']
-        response += content
-        if token_callback:
-            token_callback(content)
 
+class ModelUnavailable(Exception):
+    pass
+
+
+def strip_thinking(response: str) -> str:
     if "<think>" in response:
-        response = response[response.index("</think>") + 10:]
+        return response[response.index("</think>") + 10:]
     return response
 
 
+def call(model: str, prompt: str | list[dict], token_callback=None, options: dict | None = None,
+         use_cache: bool = True, task: str = "llm", schema: type[BaseModel] | None = None,
+         validate: Callable[[str], bool] | None = None) -> str:
+    # validate decides whether a response may be cached, e.g. a free-text answer that parses
+    # A list continues a conversation, Ollama reuses the KV cache of the unchanged message prefix
+    messages = prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+    options = request_options(task, options)
+
+    # Routed tasks run on their configured models first, a model that is not available falls back to the next one
+    models = route(task, model)
+    for attempt, routed_model in enumerate(models):
+        fallback = attempt < len(models) - 1
+        try:
+            response = _call_model(routed_model, messages, token_callback, options, use_cache, task, schema,
+                                   validate, fallback, requested_model=model)
+            break
+        except ModelUnavailable as e:
+            print(f"Modell {routed_model} für {task} nicht verfügbar ({e.__cause__}), versuche "
+                  f"{models[attempt + 1]}")
+
+    return strip_thinking(response)
+
+
+def _call_model(model: str, messages: list[dict], token_callback, options: dict, use_cache: bool, task: str,
+                schema: type[BaseModel] | None, validate: Callable[[str], bool] | None, fallback: bool,
+                requested_model: str) -> str:
+    key = cache_key(model, messages, options)
+    prompt_chars = sum(len(message["content"]) for message in messages)
+
+    with span("llm", task=task, model=model, prompt_chars=prompt_chars) as record:
+        if model != requested_model:
+            record["requested_model"] = requested_model
+        response = load_response(key) if use_cache else None
+        record["cached"] = response is not None
+
+        if response is not None:
+            # Cached responses are replayed as a single chunk
+            if token_callback:
+                token_callback(response)
+        else:
+            stream = chat_stream(model, messages, options, format=schema.model_json_schema() if schema else None)
+            parts = []
+            start = time.perf_counter()
+
+            try:
+                for chunk in stream:
+                    content = chunk['message']['content']
+                    if content:
+                        if not parts:
+                            record["time_to_first_token"] = time.perf_counter() - start
+                        parts.append(content)
+                        if token_callback:
+                            token_callback(content)
+                    if chunk.get('done'):
+                        add_eval_stats(record, chunk)
+                    # Models tend to pad constrained output with whitespace, the request is closed as soon as the
+                    # JSON document is complete
+                    elif schema and content.rstrip().endswith("}") and is_complete_json("".join(parts)):
+                        record["stopped_early"] = True
+                        stream.close()
+                        break
+            except Exception as e:
+                # Once tokens were shown, another model would start the answer over
+                if fallback and not parts and model_unavailable(e):
+                    raise ModelUnavailable() from e
+                raise
+            response = "".join(parts)
+
+            # A truncated or invalid response would be replayed from the cache forever, and fail on every retry
+            valid = (schema is None or matches_schema(response, schema)) and \
+                (validate is None or validate(strip_thinking(response)))
+            if use_cache and valid:
+                store_response(key, model, response)
+    return response
+
+
+def parse_structured(response: str, schema: type[BaseModel], task: str) -> BaseModel:
+    try:
+        return schema.model_validate_json(response)
+    except ValidationError as e:
+        raise ValueError(f"Ungültige Antwort für {task}: {e}\n{response}")
+
+
+def call_structured(model: str, prompt: str, schema: type[BaseModel], task: str, options: dict | None = None,
+                    use_cache: bool = True, token_callback=None) -> BaseModel:
+    prompt += STRUCTURED_SUFFIX.format(schema=json.dumps(schema.model_json_schema(), ensure_ascii=False))
+    response = call(model, prompt, token_callback, options=options, use_cache=use_cache, task=task, schema=schema)
+    return parse_structured(response, schema, task)
+
+
 def generate_title(theme: str, model: str) -> str:
     prompt = TITLE_PROMPT_TEMPLATE.format(theme=theme)
-    title = call(model, prompt)
+    if STRUCTURED_OUTPUT:
+        return call_structured(model, prompt, Title, task="title").title.strip('"* \n')
+    title = call(model, prompt, task="title")
     return title.strip('"* \n')
 
 
-def generate_story_outline(theme: str, model: str) -> list[str]:
-    prompt = STRUCTURE_PROMPT_TEMPLATE.format(theme=theme)
-    outline = call(model, prompt)
-    steps = [line.strip().split('. ', 1)[1] for line in outline.strip().split('\n') if '. ' in line]
-    return steps
+def story_structure(page_count: int) -> list[tuple[str, int]]:
+    sections = STORY_SECTIONS
+    if page_count < len(sections):
+        # Very short books skip the middle sections
+        sections = [sections[0]] + sections[len(sections) - page_count + 1:]
+    total = sum(weight for _, weight in sections)
+    shares = [page_count * weight / total for _, weight in sections]
+    counts = [int(share) for share in shares]
+    # Pages lost to rounding go to the sections with the largest remainders
+    for i in sorted(range(len(sections)), key=lambda i: counts[i] - shares[i])[:page_count - sum(counts)]:
+        counts[i] += 1
+    return [(name, count) for (name, _), count in zip(sections, counts)]
+
+
+def structure_prompt(theme: str, page_count: int = PAGE_COUNT) -> str:
+    structure = ", \n".join(f"{count} {'Seite' if count == 1 else 'Seiten'} {name}"
+                            for name, count in story_structure(page_count))
+    return STRUCTURE_PROMPT_TEMPLATE.format(theme=theme, page_count=page_count, structure=structure + ".")
+
+
+def outline_schema(schema: type[BaseModel], page_count: int) -> type[BaseModel]:
+    # One outline step per page
+    return create_model(schema.__name__, __base__=schema,
+                        steps=(List[str], Field(min_length=page_count, max_length=page_count)))
+
+
+def context_window(index: int) -> range:
+    return range(max(1, index - CONTEXT_WINDOW_PAGES), index)
+
+
+def parse_outline(outline: str) -> list[str]:
+    return [line.strip().split('. ', 1)[1] for line in outline.strip().split('\n') if '. ' in line]
+
+
+def outline_options(page_count: int) -> dict:
+    # The outline grows with the book, the default limit of the outline task only fits short ones. One step takes
+    # up to ~64 tokens, plus quotes and commas when it is a JSON string.
+    return {"num_predict": 80 * page_count + 256}
+
+
+def clean_step(step: str) -> str:
+    # The prompt asks for a numbered list, which some models repeat inside the JSON strings
+    return re.sub(r"^\d+\.\s*", "", step.strip())
+
+
+def partial_outline(text: str) -> list[str]:
+    # Steps already complete in a streamed outline, so it can be shown while it is written
+    if not STRUCTURED_OUTPUT:
+        return parse_outline(text[:text.rfind("\n") + 1])
+    start = text.find('"steps"')
+    if start < 0:
+        return []
+    return [clean_step(json.loads(f'"{step}"')) for step in JSON_STRING_PATTERN.findall(text, start + len('"steps"'))]
+
+
+def generate_story_outline(theme: str, model: str, page_count: int = PAGE_COUNT, token_callback=None) -> list[str]:
+    prompt = structure_prompt(theme, page_count)
+    if STRUCTURED_OUTPUT:
+        steps = call_structured(model, prompt, outline_schema(StoryOutline, page_count), task="outline",
+                                options=outline_options(page_count), token_callback=token_callback).steps
+        return [clean_step(step) for step in steps]
+    # The outline is only cached once it has the right number of steps
+    outline = parse_outline(call(model, prompt, token_callback, task="outline", options=outline_options(page_count),
+                                 validate=lambda response: len(parse_outline(response)) == page_count))
+    if len(outline) != page_count:
+        raise ValueError(f"Gliederung hat {len(outline)} statt {page_count} Schritte")
+    return outline
 
 
 def generate_page_text_from_outline(theme: str, title: str, outline: list[str], index: int, model: str) -> str:
-    outline_str = "\n".join(f"{i + 1}. {step}" for i, step in enumerate(outline))
+    # Only the outline steps around the page, in long books the full outline would dominate every prompt
+    steps = range(max(1, index - CONTEXT_WINDOW_PAGES), min(len(outline), index + CONTEXT_WINDOW_PAGES) + 1)
+    outline_str = "\n".join(f"{i}. {outline[i - 1]}" for i in steps)
     prompt = TEXT_FROM_STRUCTURE_PROMPT_TEMPLATE.format(theme=theme, title=title, outline=outline_str, index=index)
-    raw_text = call(model, prompt)
+    if STRUCTURED_OUTPUT:
+        return call_structured(model, prompt, PageText, task="page_text").text.strip()
+    raw_text = call(model, prompt, task="page_text")
     return clean_page_text(raw_text)
 
 
@@ -137,24 +354,97 @@ def generate_image_description(theme: str, title: str, content: str, index: int,
     characters_str = "\n".join(characters)
     prompt = IMAGE_PROMPT_TEMPLATE.format(theme=theme, title=title, content=content, index=index, text=text)
     prompt = f"The main characters in this book are:\n{characters_str}\n\n{prompt}"
-    return call(model, prompt)
+    if STRUCTURED_OUTPUT:
+        return call_structured(model, prompt, ImageDescription, task="image_description").description.strip()
+    return call(model, prompt, task="image_description")
+
+
+def generate_pages(theme: str, title: str, outline: list[str], characters: list[str] | Future, model: str,
+                   executor: ThreadPoolExecutor, page_count: int = PAGE_COUNT,
+                   page_callback: Callable[[int, Page], None] | None = None) -> list[Page]:
+    # All page texts only depend on the outline and fan out at once. The image description of page i needs the
+    # texts of page i and the context window before it, so it is submitted as soon as those are complete and
+    # later parts of a long book don't wait for earlier chapters.
+    text_futures = {submit(executor, generate_page_text_from_outline, theme, title, outline, i, model): i
+                    for i in range(1, page_count + 1)}
+    if isinstance(characters, Future):
+        characters = characters.result()
+    texts: dict[int, str] = {}
+    page_futures = {}
+    waiting = list(range(1, page_count + 1))
+
+    # The page callback sees every page as soon as its image description is final
+    def describe_page(index: int, prior_texts: str) -> Page:
+        image_description = generate_image_description(theme, title, prior_texts, index, texts[index], model,
+                                                       characters)
+        page = Page(text=texts[index], image_description=image_description)
+        if page_callback:
+            page_callback(index, page)
+        return page
+
+    for future in as_completed(text_futures):
+        texts[text_futures[future]] = future.result()
+        for index in [i for i in waiting if i in texts and all(j in texts for j in context_window(i))]:
+            prior_texts = "\n".join(f"{j}. {texts[j]}" for j in context_window(index))
+            page_futures[index] = submit(executor, describe_page, index, prior_texts)
+            waiting.remove(index)
+
+    return [page_futures[i].result() for i in range(1, page_count + 1)]
+
+
+def converse(model: str, messages: list[dict], prompt: str, schema: type[BaseModel], task: str,
+             options: dict | None = None) -> BaseModel:
+    # The raw response is kept in the history, so the next turn matches the tokens Ollama still has cached
+    messages.append({"role": "user", "content": prompt})
+    response = call(model, messages, options=options, task=task, schema=schema)
+    messages.append({"role": "assistant", "content": response})
+    return parse_structured(response, schema, task)
+
+
+def generate_book_in_conversation(theme: str, model: str, page_count: int = PAGE_COUNT,
+                                  page_callback: Callable[[int, Page], None] | None = None) -> Storyline:
+    # One conversation instead of a fresh prompt per page: every turn only prefills the new user message, while
+    # the parallel engine resends outline and prior pages for each page
+    messages = [{"role": "system", "content": BOOK_SYSTEM_PROMPT_TEMPLATE.format(page_count=page_count, theme=theme)}]
+    # The plan is the outline plus title and characters
+    plan_tokens = outline_options(page_count)["num_predict"] + TASK_OPTIONS["characters"]["num_predict"]
+    plan = converse(model, messages, BOOK_PLAN_PROMPT_TEMPLATE.format(page_count=page_count),
+                    outline_schema(BookPlan, page_count), "book_plan", options={"num_predict": plan_tokens})
 
-
-def generate_storyline(state: State) -> State:
+    pages = []
+    for index in range(1, page_count + 1):
+        result = converse(model, messages, BOOK_PAGE_PROMPT_TEMPLATE.format(index=index), BookPage, "book_page")
+        page = Page(text=result.text.strip(), image_description=result.image_description.strip())
+        if page_callback:
+            page_callback(index, page)
+        pages.append(page)
+        # Once the history holds twice the context window, the older half of the pages is dropped. The prefix
+        # cache only misses at these points, not on every page.
+        if len(messages) > 3 + 4 * CONTEXT_WINDOW_PAGES:
+            del messages[3:3 + 2 * CONTEXT_WINDOW_PAGES]
+
+    return Storyline(title=plan.title.strip('"* \n'), pages=pages)
+
+
+def generate_storyline(state: State, max_workers: int = MAX_PARALLEL_CALLS,
+                       page_callback: Callable[[int, Page], None] | None = None,
+                       page_count: int | None = None) -> State:
     if "storyline" in state:
         return state
 
-    title = generate_title(state.selected_topic, state.model)
-    outline = generate_story_outline(state.selected_topic, state.model)
-    character_descriptions = generate_character_descriptions(state.selected_topic, state.model)
-
-    pages = []
-    for i in range(1, 8):
-        page_text = generate_page_text_from_outline(state.selected_topic, title, outline, i, state.model)
-        prior_texts = "\n".join([f"{j + 1}. {p.text}" for j, p in enumerate(pages)])
-        image_description = generate_image_description(state.selected_topic, title, prior_texts, i, page_text,
-                                                       state.model, character_descriptions)
-        pages.append(Page(text=page_text, image_description=image_description))
+    theme, model = state.selected_topic, state.model
+    page_count = page_count or state.page_count or PAGE_COUNT
+    if state.engine == "conversation":
+        state.storyline = generate_book_in_conversation(theme, model, page_count, page_callback)
+        return state
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        title_future = submit(executor, generate_title, theme, model)
+        outline_future = submit(executor, generate_story_outline, theme, model, page_count)
+        characters_future = submit(executor, generate_character_descriptions, theme, model)
+
+        title = title_future.result()
+        pages = generate_pages(theme, title, outline_future.result(), characters_future, model, executor,
+                               page_count, page_callback)
 
     state.storyline = Storyline(title=title, pages=pages)
     return state
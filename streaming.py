@@ -0,0 +1,35 @@
+import time
+from typing import Callable
+
+# Streamlit re-renders the whole element on every update, more than ~15 frames per second are not visible anyway
+FRAME_INTERVAL = 0.075
+MAX_PENDING_TOKENS = 64
+
+
+class CoalescingStream:
+    # Token callback for call(): collects tokens and hands the text so far to render at a bounded frame rate, so
+    # the number of renders depends on the duration of the stream instead of its length
+    def __init__(self, render: Callable[[str], None], interval: float = FRAME_INTERVAL,
+                 max_pending: int = MAX_PENDING_TOKENS):
+        self.render = render
+        self.interval = interval
+        self.max_pending = max_pending
+        self.parts: list[str] = []
+        self.pending = 0
+        self.last_render = 0.0
+
+    def __call__(self, token: str) -> None:
+        self.parts.append(token)
+        self.pending += 1
+        if self.pending >= self.max_pending or time.monotonic() - self.last_render >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.render("".join(self.parts))
+            self.pending = 0
+            self.last_render = time.monotonic()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
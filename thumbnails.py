@@ -0,0 +1,62 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Previews for the review gallery, the full-resolution PNGs are only read for the PDF
+THUMBNAIL_SIZE = int(os.environ.get("BILDERBUCH_THUMBNAIL_SIZE", "384"))
+THUMBNAIL_FORMAT = os.environ.get("BILDERBUCH_THUMBNAIL_FORMAT", "WEBP").upper()
+THUMBNAIL_QUALITY = 80
+MAX_CACHED_THUMBNAILS = 256
+
+EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg"}
+
+# Encoded previews keyed by image path and modification time, so a regenerated image gets a new entry
+_cache: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+_lock = threading.Lock()
+
+
+def thumbnail_path(image_path: str) -> str:
+    return f"{os.path.splitext(image_path)[0]}.thumb{EXTENSIONS[THUMBNAIL_FORMAT]}"
+
+
+def write_thumbnail(image: "Image.Image", image_path: str) -> str:
+    # Called with the image that was just rendered or opened, so it is not decoded a second time
+    from PIL import Image
+
+    path = thumbnail_path(image_path)
+    preview = image.convert("RGB")
+    preview.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    preview.save(tmp_path, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    os.replace(tmp_path, path)
+    return path
+
+
+def thumbnail(image_path: str) -> bytes:
+    # Images copied from the image cache or rendered before previews existed get theirs on first view
+    mtime = os.stat(image_path).st_mtime_ns
+    key = (image_path, mtime)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    path = thumbnail_path(image_path)
+    if not os.path.exists(path) or os.stat(path).st_mtime_ns < mtime:
+        # PIL stays out of the app startup, it is only needed for images without a preview
+        from PIL import Image
+
+        with Image.open(image_path) as image:
+            write_thumbnail(image, image_path)
+    with open(path, "rb") as f:
+        data = f.read()
+
+    with _lock:
+        _cache[key] = data
+        while len(_cache) > MAX_CACHED_THUMBNAILS:
+            _cache.popitem(last=False)
+    return data
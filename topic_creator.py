@@ -1,8 +1,8 @@
 import json
 
-from ollama import chat
-
-from model import State, load_state
+from model import State, TopicSuggestions
+from run_store import load_state
+from storyline_creator import STRUCTURED_OUTPUT, call, call_structured
 
 PROMPT = '''
 Du bist Paul, ein erfahrener Kinderbuchredakteur in einem großen Verlag. 
@@ -16,16 +16,33 @@ Gib deine Antwort als JSON-Liste mit genau drei kindgerechten Buchtiteln zurück
 '''
 
 
-def suggest_book_topics(state: State) -> State:
-    response = chat(model=state.model, messages=[{"role": "user", "content": PROMPT}])
-    output = response.message.content
+def parse_topics(output: str) -> list[str]:
     try:
-        start = output.find("[")
-        end = output.rfind("]") + 1
-        state.suggested_topics = json.loads(output[start:end])
-        return state
-    except Exception as e:
+        topics = json.loads(output[output.find("["):output.rfind("]") + 1])
+    except ValueError as e:
         raise ValueError(f"Konnte Themenvorschläge nicht parsen: {e}\n{output}")
+    if not isinstance(topics, list):
+        raise ValueError(f"Konnte Themenvorschläge nicht parsen: keine Liste\n{output}")
+    return topics
+
+
+def valid_topics(output: str) -> bool:
+    try:
+        parse_topics(output)
+        return True
+    except ValueError:
+        return False
+
+
+def suggest_topics(model: str, use_cache: bool = True) -> list[str]:
+    if STRUCTURED_OUTPUT:
+        return call_structured(model, PROMPT, TopicSuggestions, task="topics", use_cache=use_cache).topics
+    return parse_topics(call(model, PROMPT, task="topics", use_cache=use_cache, validate=valid_topics))
+
+
+def suggest_book_topics(state: State, use_cache: bool = True) -> State:
+    state.suggested_topics = suggest_topics(state.model, use_cache)
+    return state
 
 
 if __name__ == "__main__":
@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Iterator, Optional
+
+TRACE_FILENAME = "trace.jsonl"
+
+# Run directory the spans of the current thread are written to, None disables tracing
+_run_dir: ContextVar[Optional[str]] = ContextVar("run_dir", default=None)
+_lock = threading.Lock()
+
+
+@contextmanager
+def trace_run(run_id: str) -> Iterator[None]:
+    token = _run_dir.set(run_id)
+    try:
+        yield
+    finally:
+        _run_dir.reset(token)
+
+
+def submit(executor: Executor, fn, *args, **kwargs) -> Future:
+    # Executor threads do not inherit context variables, so the task runs in a copy of the caller's context
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+@contextmanager
+def span(stage: str, **attributes) -> Iterator[dict]:
+    record = {"stage": stage, **attributes, "start": time.time()}
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        write(record)
+
+
+def write(record: dict) -> None:
+    run_dir = _run_dir.get()
+    if run_dir is None:
+        return
+    with _lock, open(os.path.join(run_dir, TRACE_FILENAME), "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def load_trace(run_id: str) -> list[dict]:
+    path = os.path.join(run_id, TRACE_FILENAME)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records: list[dict]) -> list[dict]:
+    # LLM calls are broken down by task, e.g. "llm:page_text"
+    stages = {}
+    for record in records:
+        name = f"{record['stage']}:{record['task']}" if "task" in record else record["stage"]
+        stage = stages.setdefault(name, {"stage": name, "count": 0, "seconds": 0.0})
+        stage["count"] += 1
+        stage["seconds"] += record["seconds"]
+    for stage in stages.values():
+        stage["mean_seconds"] = stage["seconds"] / stage["count"]
+    return sorted(stages.values(), key=lambda stage: stage["seconds"], reverse=True)
+
+
+def task_stats(records: list[dict]) -> list[dict]:
+    # Latency and tokens of the LLM calls per task and model, to tune BILDERBUCH_MODEL_ROUTES. Cached responses
+    # and failed calls, e.g. of a model that fell back to the next one, are only counted.
+    groups = {}
+    for record in records:
+        if record["stage"] != "llm":
+            continue
+        key = (record["task"], record["model"])
+        group = groups.setdefault(key, {"task": key[0], "model": key[1], "count": 0, "cached": 0, "errors": 0,
+                                        "calls": []})
+        group["count"] += 1
+        if record.get("error"):
+            group["errors"] += 1
+        elif record.get("cached"):
+            group["cached"] += 1
+        else:
+            group["calls"].append(record)
+
+    stats = []
+    for group in groups.values():
+        calls = group.pop("calls")
+        for name, field in [("mean_seconds", "seconds"), ("mean_time_to_first_token", "time_to_first_token"),
+                            ("mean_output_tokens", "eval_count"), ("tokens_per_second", "tokens_per_second")]:
+            values = [call[field] for call in calls if call.get(field) is not None]
+            group[name] = sum(values) / len(values) if values else None
+        stats.append(group)
+    return sorted(stats, key=lambda group: (group["task"], group["model"]))
+
+
+def add_eval_stats(record: dict, response) -> None:
+    # Ollama reports token counts and durations (in nanoseconds) with the final chunk of a response
+    record["prompt_eval_count"] = response.get("prompt_eval_count")
+    record["eval_count"] = response.get("eval_count")
+    if response.get("eval_count") and response.get("eval_duration"):
+        record["tokens_per_second"] = response["eval_count"] / response["eval_duration"] * 1e9